@@ -26,23 +26,15 @@ Command-line driver for the module
 import logging
 import os
 import sys
-import yaml
+import subprocess
 
-from bisect import bisect
-from shutil import copyfile
-from textgrid import MLF
-
-from .corpus import Corpus
-from .aligner import Aligner
-from .archive import Archive
-from .utilities import splitname, resolve_opts, \
-                       ALIGNED, CONFIG, HMMDEFS, MACROS, SCORES
+from .api import Model, OPTIONS
+from .server import AlignerServer
+from .utilities import FEATURE_CACHE_SIZE, DICTIONARY, MODEL, RESAMPLER
+from .wavfile import RESAMPLERS
 
 from argparse import ArgumentParser
 
-DICTIONARY = "eng.dict"
-MODEL = "eng.zip"
-
 LOGGING_FMT = "%(message)s"
 
 
@@ -55,105 +47,144 @@ argparser.add_argument("-d", "--dictionary", metavar="DICT", action="append",
                        help="dictionary file (default: {}) (can specify multiple)".format(DICTIONARY))
 argparser.add_argument("-s", "--samplerate", type=int,
                        help="analysis samplerate (in Hz)")
+argparser.add_argument("--resampler", choices=RESAMPLERS,
+                       help="resampling method " +
+                            "(default: {})".format(RESAMPLER))
+argparser.add_argument("--channel", type=int,
+                       help="channel to use from multichannel audio " +
+                            "(default: mix all channels down)")
 argparser.add_argument("-e", "--epochs", type=int,
-                       help="# of epochs of training per round")
+                       help="(maximum) # of epochs of training per round")
+argparser.add_argument("--min-epochs", type=int,
+                       help="minimum # of epochs of training per round " +
+                            "(default: 1)")
+argparser.add_argument("--convergence-threshold", type=float,
+                       help="end a round of training once the average " +
+                            "log likelihood per frame improves by less " +
+                            "than this (default: never)")
+argparser.add_argument("-j", "--jobs", type=int,
+                       help="# of parallel jobs (default: 1)")
+argparser.add_argument("--shards", type=int,
+                       help="# of shards to split the corpus into " +
+                            "(default: # of jobs)")
+argparser.add_argument("--feature-cache", metavar="DIR",
+                       help="directory for caching features (and " +
+                            "compiled dictionaries) across runs")
+argparser.add_argument("--feature-cache-size", metavar="MB", type=int,
+                       help="maximum size of feature cache " +
+                            "(default: {} MB)".format(FEATURE_CACHE_SIZE))
+argparser.add_argument("--workdir", metavar="DIR",
+                       help="directory in which to keep (and checkpoint) " +
+                            "models during training")
+argparser.add_argument("--resume", action="store_true",
+                       help="resume training from the last checkpoint " +
+                            "in the work directory")
+argparser.add_argument("--timeout", metavar="SECONDS", type=float,
+                       help="kill any HTK command which runs longer " +
+                            "than this")
+argparser.add_argument("--retries", type=int,
+                       help="# of times to retry a failed HTK command " +
+                            "(default: 0)")
+argparser.add_argument("--trace", action="store_true",
+                       help="log each HTK command line as it is run")
+argparser.add_argument("--table", metavar="FILE",
+                       help="also write all aligned intervals to a single " +
+                            "table (.csv, .jsonl, or .parquet)")
+argparser.add_argument("--incremental", action="store_true",
+                       help="only align utterances which have changed " +
+                            "since the last incremental run")
+argparser.add_argument("--binary", action="store_true",
+                       help="write the acoustic model in HTK's binary " +
+                            "format, which loads faster")
+argparser.add_argument("--model-cache", metavar="DIR",
+                       help="directory in which to keep unpacked " +
+                            "acoustic models (and compiled dictionaries) " +
+                            "for reuse across runs")
 input_group = argparser.add_argument_group()
 input_group.add_argument("-r", "--read",
                          help="source for a precomputed acoustic model")
 input_group.add_argument("-t", "--train",
-                         help="directory containing data for training")
+                         help="directory (or manifest) of data for training")
 output_group = argparser.add_mutually_exclusive_group(required=True)
 output_group.add_argument("-a", "--align",
-                          help="directory containing data to align")
+                          help="directory (or manifest) of data to align")
 output_group.add_argument("-w", "--write",
                           help="destination for computed acoustic model")
+output_group.add_argument("--serve", metavar="HOST:PORT",
+                          help="serve alignment requests over HTTP")
+argparser.add_argument("--serve-root", metavar="DIR",
+                       help="directory under which alignment requests " +
+                            "may name files (by default, they may not)")
+argparser.add_argument("--long-audio", metavar="SECONDS", type=float,
+                       help="split recordings longer than this into " +
+                            "chunks for alignment")
 verbosity_group = argparser.add_mutually_exclusive_group()
 verbosity_group.add_argument("-v", "--verbose", action="store_true",
                              help="Verbose output")
 verbosity_group.add_argument("-V", "--extra-verbose", action="store_true",
                              help="Even more verbose output")
-args = argparser.parse_args()
 
-# hack to allow proper override of default dictionary
-if not args.dictionary:
-    args.dictionary = [DICTIONARY]
 
-# set up logging
-loglevel = logging.WARNING
-if args.extra_verbose:
-    loglevel = logging.DEBUG
-elif args.verbose:
-    loglevel = logging.INFO
-logging.basicConfig(format=LOGGING_FMT, level=loglevel)
+def main(argv=None):
+    args = argparser.parse_args(argv)
+    # hack to allow proper override of default dictionary
+    if not args.dictionary:
+        args.dictionary = [DICTIONARY]
+    # set up logging
+    loglevel = logging.WARNING
+    if args.extra_verbose:
+        loglevel = logging.DEBUG
+    elif args.verbose or args.trace:
+        loglevel = logging.INFO
+    logging.basicConfig(format=LOGGING_FMT, level=loglevel)
+    options = {option: getattr(args, option) for option in OPTIONS}
+    # input: pick one
+    if args.train:
+        if args.read:
+            logging.error("Cannot train on persistent model.")
+            exit(1)
+        model = Model.train(args.train, args.configuration, args.dictionary,
+                            **options)
+    else:
+        if not args.read:
+            args.read = MODEL
+        logging.info("Reading aligner from '{}'.".format(args.read))
+        # warn about irrelevant flags (`Model.read` warns about the rest)
+        if args.configuration:
+            logging.warning("Ignoring config flag (-c/--configuration).")
+        model = Model.read(args.read, args.dictionary,
+                           cache=args.model_cache, **options)
+    # output: pick one
+    if args.align:
+        if not model.align(args.align, args.long_audio, args.table,
+                           args.incremental):
+            logging.error("No paths found!")
+            exit(1)
+    elif args.write:
+        archive_path = os.path.relpath(model.write(args.write,
+                                                   args.binary))
+        logging.info("Wrote aligner to '{}'.".format(archive_path))
+    elif args.serve:
+        (host, _, port) = args.serve.rpartition(":")
+        try:
+            address = (host, int(port))
+        except ValueError:
+            logging.error("Cannot parse address '{}'.".format(args.serve))
+            exit(1)
+        server = AlignerServer(address, model, args.serve_root)
+        logging.info("Serving on {}:{}.".format(*server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    # else unreachable
+    logging.info("Success!")
 
-# input: pick one
-if args.train:
-    if args.read:
-        logging.error("Cannot train on persistent model.")
-        exit(1)
-    logging.info("Preparing corpus '{}'.".format(args.train))
-    opts = resolve_opts(args)
-    corpus = Corpus(args.train, opts)
-    logging.info("Preparing aligner.")
-    aligner = Aligner(opts)
-    logging.info("Training aligner on corpus '{}'.".format(args.train))
-    aligner.HTKbook_training_regime(corpus, opts["epochs"],
-                                    flatstart=(args.read is None))
-else:
-    if not args.read:
-        args.read = MODEL
-    logging.info("Reading aligner from '{}'.".format(args.read))
-    # warn about irrelevant flags
-    if args.configuration:
-        logging.warning("Ignoring config flag (-c/--configuration).")
-        args.configuration = None
-    if args.epochs:
-        logging.warning("Ignoring epochs flag (-e/--epochs).")
-    if args.samplerate:
-        logging.warning("Ignoring samplerate flag (-s/--samplerate).")
-        args.samplerate = None
-    # create archive from -r argument
-    archive = Archive(args.read)
-    # read configuration file therefrom, and resolve options with it
-    args.configuration = os.path.join(archive.dirname, CONFIG)
-    opts = resolve_opts(args)
-    # initialize aligner and set it to point to the archive data
-    aligner = Aligner(opts)
-    aligner.curdir = archive.dirname
 
-# output: pick one
-if args.align:
-    # check to make sure we're not aligning on the training data
-    if (not args.train) or (os.path.realpath(args.train) !=
-                            os.path.realpath(args.align)):
-        logging.info("Preparing corpus '{}'.".format(args.align))
-        corpus = Corpus(args.align, opts)
-    logging.info("Aligning corpus '{}'.".format(args.align))
-    aligned = os.path.join(args.align, ALIGNED)
-    scores = os.path.join(args.align, SCORES)
-    aligner.align_and_score(corpus, aligned, scores)
-    logging.debug("Wrote MLF file to '{}'.".format(aligned))
-    logging.debug("Wrote likelihood scores to '{}'.".format(scores))
-    logging.info("Writing TextGrids.")
-    size = MLF(aligned).write(args.align)
-    if not size:
-        logging.error("No paths found!")
+if __name__ == "__main__":
+    try:
+        main()
+    except subprocess.SubprocessError:
+        # the runner has already logged the command and its errors
         exit(1)
-    logging.debug("Wrote {} TextGrids.".format(size))
-elif args.write:
-    # create and populate archive
-    (_, basename, _) = splitname(args.write)
-    archive = Archive.empty(basename)
-    archive.add(os.path.join(aligner.curdir, HMMDEFS))
-    archive.add(os.path.join(aligner.curdir, MACROS))
-    # whatever this is, it's not going to work once you move the data
-    if "dictionary" in opts:
-        del opts["dictionary"]
-    with open(os.path.join(archive.dirname, CONFIG), "w") as sink:
-        yaml.dump(opts, sink)
-    (basename, _) = os.path.splitext(args.write)
-    archive_path = os.path.relpath(archive.dump(basename))
-    logging.info("Wrote aligner to '{}'.".format(archive_path))
-# else unreachable
-
-logging.info("Success!")
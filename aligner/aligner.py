@@ -24,40 +24,100 @@ Aligner utilities
 """
 
 import os
+import json
 import logging
 
 from re import match
+from hashlib import sha1
 from tempfile import mkdtemp
 from shutil import copyfile, rmtree
-from subprocess import check_call, Popen, CalledProcessError, PIPE
+from concurrent.futures import ThreadPoolExecutor
 
-from .utilities import opts2cfg, mkdir_p, \
-                       HMMDEFS, MACROS, PROTO, SP, SIL, TEMP, VFLOORS
+from . import metrics
+from .cache import filehash
+from .runner import Runner
+from .mlf import read_mlf, write_mlf, cat_mlf, print_block, MLF_HEADER
+from .utilities import atomic_write, opts2cfg, mkdir_p, splitname, \
+                       HMMDEFS, MACROS, MANIFEST, PROTO, RUNTIME_OPTIONS, \
+                       SP, SIL, TEMP, VFLOORS
 
 
-# regexp for parsing the HVite trace
+# regexps for parsing the HVite trace
+HVITE_FILE = r"Aligning File: (.+)"
 HVITE_SCORE = r".+==  \[\d+ frames\] (-\d+\.\d+)"
 # in case you"re curious, the rest of the trace string is:
 #     /\[Ac=-\d+\.\d+ LM=0.0\] \(Act=\d+\.\d+\)/
 
+# bytes of an HMM definition file read to tell if it is binary
+BINARY_SNIFF = 4096
+
+# regexp for parsing the HERest trace
+HEREST_LIKELIHOOD = r"average log prob per frame = (\S+)"
+
+
+def _is_binary(filename):
+    """
+    Guess whether an HMM definition file is in HTK's binary format, in
+    which (unlike the text format) parameters are written as raw floats
+    """
+    with open(filename, "rb") as source:
+        return b"\0" in source.read(BINARY_SNIFF)
+
+
+def _likelihood(trace):
+    """
+    Get the average log likelihood per frame from the HERest trace, or
+    None if it is not found
+    """
+    for line in trace.decode("UTF-8").splitlines():
+        m = match(r".*" + HEREST_LIKELIHOOD, line)
+        if m:
+            return float(m.group(1))
+
 
 class Aligner(object):
 
     """
     Class representing an aligner, including HMM definitions and 
-    configuration options
+    configuration options.
+
+    If `opts["workdir"]` is set, the HMMs are kept there rather than in a
+    temporary directory, and each stage of training is recorded in a
+    manifest as it completes; if `opts["resume"]` is also set, stages
+    already recorded are skipped, so long as the training data and
+    options are unchanged and their outputs are intact.
     """
 
-    def __init__(self, opts):
-        # make temporary directories to stash everything
-        hmmdir = os.environ["TMPDIR"] if "TMPDIR" in os.environ else None
-        self.hmmdir = mkdtemp(dir=hmmdir)
+    def __init__(self, opts, runner=None):
+        # runs the HTK tools
+        self.runner = runner or Runner.from_opts(opts)
+        if opts.get("workdir"):
+            self.hmmdir = os.path.abspath(opts["workdir"])
+            mkdir_p(self.hmmdir)
+            self.is_tmpdir = False
+        else:
+            # make temporary directories to stash everything
+            hmmdir = os.environ["TMPDIR"] if "TMPDIR" in os.environ \
+                     else None
+            self.hmmdir = mkdtemp(dir=hmmdir)
+            self.is_tmpdir = True
+        self.resume = opts.get("resume", False)
+        # everything but runtime settings can change the result
+        settings = {key: value for (key, value) in opts.items() if
+                    key not in RUNTIME_OPTIONS and key != "dictionary"}
+        self.settings = json.dumps(settings, sort_keys=True, default=str)
+        self.manifest = None
         # config options
         self.HCompV_opts = opts["HCompV"]
         self.HERest_cfg = os.path.join(self.hmmdir, "HERest.cfg")
         opts2cfg(self.HERest_cfg, opts["HERest"])
         self.HVite_opts = opts["HVite"]
         self.pruning = [str(i) for i in opts["pruning"]]
+        self.jobs = opts["jobs"]
+        self.shards = opts["shards"]
+        # early stopping
+        self.convergence_threshold = opts["convergence_threshold"]
+        self.min_epochs = opts["min_epochs"]
         # initialize directories
         self.epochs = 0
         self.curdir = os.path.join(self.hmmdir, str(self.epochs).zfill(3))
@@ -75,7 +135,138 @@ class Aligner(object):
         self.nxtdir = os.path.join(self.hmmdir, str(self.epochs).zfill(3))
         mkdir_p(self.nxtdir)
 
+    def digest(self):
+        """
+        Compute a digest of the current HMMs and the settings with which
+        they were trained
+        """
+        digest = sha1(self.settings.encode("UTF-8"))
+        for filename in (MACROS, HMMDEFS):
+            digest.update(filehash(os.path.join(self.curdir,
+                                                filename)).encode("UTF-8"))
+        return digest.hexdigest()
+
+    def _fingerprint(self, corpus):
+        """
+        Compute a digest of the training data and options
+        """
+        digest = sha1(self.settings.encode("UTF-8"))
+        for filename in (corpus.phons, corpus.taskdict):
+            digest.update(filehash(filename).encode("UTF-8"))
+        # label file names include the (temporary) corpus directory
+        for (name, lines) in read_mlf(corpus.word_mlf):
+            digest.update("\n".join([splitname(name)[1]] + lines +
+                                     ["."]).encode("UTF-8"))
+        for featurefile in corpus.featurefiles:
+            digest.update(filehash(featurefile).encode("UTF-8"))
+        return digest.hexdigest()
+
+    def _write_manifest(self):
+        with atomic_write(os.path.join(self.hmmdir, MANIFEST)) as sink:
+            json.dump(self.manifest, sink, indent=1)
+
+    def _begin(self, corpus):
+        """
+        Start recording stages of training in the manifest, first reading
+        those recorded by an earlier run if resuming
+        """
+        if self.is_tmpdir:
+            return
+        fingerprint = self._fingerprint(corpus)
+        self.manifest = {"fingerprint": fingerprint, "stages": []}
+        # stages from an earlier run, yet to be reached in this one, or
+        # None once we are no longer resuming
+        self.completed = None
+        if not self.resume:
+            self._write_manifest()
+            return
+        try:
+            with open(os.path.join(self.hmmdir, MANIFEST), "r") as source:
+                manifest = json.load(source)
+        except FileNotFoundError:
+            logging.info("No manifest in '{}'.".format(self.hmmdir))
+            return
+        if manifest["fingerprint"] != fingerprint:
+            logging.warning("Training data or options have changed; " +
+                            "not resuming.")
+            self._write_manifest()
+            return
+        self.completed = manifest["stages"]
+
+    def _intact(self, entry):
+        """
+        Check that the output of a completed stage is as it was recorded
+        """
+        curdir = os.path.join(self.hmmdir, entry["curdir"])
+        try:
+            for (filename, digest) in entry["digests"].items():
+                if filehash(os.path.join(curdir, filename)) != digest:
+                    return False
+            for filename in entry["saved"].values():
+                if not os.path.exists(os.path.join(self.hmmdir, filename)):
+                    return False
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _resumed(self, stage, corpus):
+        """
+        If stage `stage` was completed by an earlier run, restore the state
+        following it and return its manifest entry; otherwise, return None
+        """
+        if self.manifest is None or self.completed is None:
+            return None
+        if self.completed and self.completed[0]["name"] == stage and \
+                self._intact(self.completed[0]):
+            entry = self.completed.pop(0)
+            logging.debug("Skipping completed stage '{}'.".format(stage))
+            self.curdir = os.path.join(self.hmmdir, entry["curdir"])
+            self.epochs = entry["epochs"]
+            self.nxtdir = os.path.join(self.hmmdir,
+                                       str(self.epochs).zfill(3))
+            mkdir_p(self.nxtdir)
+            for (key, filename) in entry["saved"].items():
+                copyfile(os.path.join(self.hmmdir, filename),
+                         getattr(corpus, key))
+            self.manifest["stages"].append(entry)
+            return entry
+        if self.manifest["stages"]:
+            logging.info("Resuming training at stage '{}'.".format(stage))
+        # forget any later stages, since they will be redone
+        self.completed = None
+        self._write_manifest()
+        return None
+
+    def _checkpoint(self, stage, corpus, saved=(), **info):
+        """
+        Record the completion of stage `stage` in the manifest, together
+        with copies of any of the corpus' label files (named by the
+        attributes in `saved`) which it modified, and any other `info`
+        """
+        if self.manifest is None:
+            return
+        entry = {"name": stage,
+                 "curdir": os.path.relpath(self.curdir, self.hmmdir),
+                 "epochs": self.epochs,
+                 "digests": {filename: filehash(os.path.join(self.curdir,
+                                                             filename))
+                             for filename in (MACROS, HMMDEFS)},
+                 "saved": {}}
+        entry.update(info)
+        for key in saved:
+            source = getattr(corpus, key)
+            filename = "{}.{}".format(stage, os.path.basename(source))
+            # patterns, so they match the next corpus' label files too
+            write_mlf(os.path.join(self.hmmdir, filename),
+                      [('*/{}.lab'.format(splitname(name)[1]), lines)
+                       for (name, lines) in read_mlf(source)])
+            entry["saved"][key] = filename
+        self.manifest["stages"].append(entry)
+        self._write_manifest()
+
     def flatstart(self, corpus):
+        if self._resumed("flatstart", corpus):
+            return
         self.epochs = 1
         # make `proto`
         self.proto = os.path.join(self.hmmdir, PROTO)
@@ -103,14 +294,15 @@ class Aligner(object):
  0.0 0.0 0.0 0.0 0.0
 <ENDHMM>""", file=proto)
         # make `vFloors`
-        check_call(["HCompV", "-m",
-                              "-f", str(self.HCompV_opts["F"]),
-                              "-C", self.HERest_cfg,
-                              "-S", corpus.feature_scp,
-                              "-M", self.curdir, self.proto])
+        with metrics.stage("HCompV", items=len(corpus.audiofiles)):
+            self.runner.run(["HCompV", "-m",
+                                       "-f", str(self.HCompV_opts["F"]),
+                                       "-C", self.HERest_cfg,
+                                       "-S", corpus.feature_scp,
+                                       "-M", self.curdir, self.proto])
         # make `macros`
         # get first three lines from local proto
-        with open(os.path.join(self.curdir, MACROS), "a") as macros:
+        with open(os.path.join(self.curdir, MACROS), "w") as macros:
             with open(os.path.join(self.curdir,
                       os.path.split(self.proto)[1]), "r") as proto:
                 for _ in range(3):
@@ -126,30 +318,127 @@ class Aligner(object):
                 for phone in phons:
                     print('~h "{}"'.format(phone.rstrip()), file=hmmdefs)
                     print("".join(protolines).rstrip(), file=hmmdefs)
+        self._checkpoint("flatstart", corpus)
+
+    def _shards(self, corpus):
+        """
+        Split the feature .scp file into `self.shards` shards, balanced by
+        duration, returning a list of (indices, prefix) pairs, where
+        `prefix` + ".scp" is the shard's feature .scp file
+        """
+        sharddir = os.path.join(self.hmmdir, "shards")
+        mkdir_p(sharddir)
+        shards = []
+        for (k, indices) in enumerate(corpus.partition(self.shards)):
+            prefix = os.path.join(sharddir, str(k).zfill(3))
+            with open(prefix + ".scp", "w") as sink:
+                for i in indices:
+                    print('"{}"'.format(corpus.featurefiles[i]), file=sink)
+            shards.append((indices, prefix))
+        return shards
+
+    def _HERest(self, corpus, scp, outdir):
+        """
+        Construct the HERest command line (minus the HMM list) for
+        reestimating on the feature files listed in `scp`
+        """
+        return ["HERest", "-C", self.HERest_cfg,
+                          "-S", scp,
+                          "-I", corpus.phon_mlf,
+                          "-M", outdir,
+                          "-H", os.path.join(self.curdir, MACROS),
+                          "-H", os.path.join(self.curdir, HMMDEFS),
+                          "-T", "1",
+                          "-t"] + self.pruning
+
+    def _parallel_HERest(self, corpus):
+        """
+        Perform one round of estimation by computing accumulators for each
+        shard in parallel (HERest -p 1...N) and then merging them (HERest
+        -p 0), returning the average log likelihood per frame reported by
+        the merge, or None if it cannot be found
+        """
+        accdir = os.path.join(self.hmmdir, "acc")
+        mkdir_p(accdir)
+        shards = self._shards(corpus)
+        # the traces of the shards are of no use, as they only dump
+        # accumulators
+        self.runner.run_all([self._HERest(corpus, prefix + ".scp", accdir) +
+                             ["-p", str(k), corpus.phons] for
+                             (k, (_, prefix)) in enumerate(shards, 1)],
+                            capture=True)
+        accs = [os.path.join(accdir, "HER{}.acc".format(k)) for k in
+                range(1, len(shards) + 1)]
+        trace = self.runner.run(["HERest", "-C", self.HERest_cfg,
+                                           "-M", self.nxtdir,
+                                           "-H", os.path.join(self.curdir,
+                                                              MACROS),
+                                           "-H", os.path.join(self.curdir,
+                                                              HMMDEFS),
+                                           "-T", "1",
+                                           "-p", "0", corpus.phons] + accs,
+                                capture=True)
+        return _likelihood(trace)
 
     def train(self, corpus, epochs):
         """
-        Perform one or more rounds of estimation
+        Perform up to `epochs` rounds of estimation, stopping early (after
+        at least `self.min_epochs`) once the average log likelihood per
+        frame improves by less than `self.convergence_threshold`
         """
+        curve = []
         for _ in range(epochs):
-            logging.debug("Training iteration {}.".format(self.epochs))
-            check_call(["HERest", "-C", self.HERest_cfg,
-                        "-S", corpus.feature_scp,
-                        "-I", corpus.phon_mlf,
-                        "-M", self.nxtdir,
-                        "-H", os.path.join(self.curdir, MACROS),
-                        "-H", os.path.join(self.curdir, HMMDEFS),
-                        "-t"] + self.pruning + [corpus.phons])
-            self._nxtdir()
+            stage = "train{}".format(str(self.epochs).zfill(3))
+            entry = self._resumed(stage, corpus)
+            if entry:
+                likelihood = entry.get("likelihood")
+            else:
+                logging.debug("Training iteration {}.".format(self.epochs))
+                with metrics.stage("HERest.{}".format(
+                                   str(self.epochs).zfill(3)),
+                                   items=len(corpus.audiofiles)):
+                    if self.shards == 1:
+                        likelihood = _likelihood(self.runner.run(
+                                                 self._HERest(corpus,
+                                                     corpus.feature_scp,
+                                                     self.nxtdir) +
+                                                 [corpus.phons],
+                                                 capture=True))
+                    else:
+                        likelihood = self._parallel_HERest(corpus)
+                self._nxtdir()
+                self._checkpoint(stage, corpus, likelihood=likelihood)
+            if likelihood is None:
+                logging.debug("No likelihood found in HERest trace.")
+                continue
+            logging.debug("Average log likelihood per frame: {}.".format(
+                          likelihood))
+            curve.append(likelihood)
+            if self.convergence_threshold is not None and \
+                    len(curve) >= max(self.min_epochs, 2) and \
+                    curve[-1] - curve[-2] < self.convergence_threshold:
+                logging.info("Converged after {} epochs.".format(len(curve)))
+                break
+        if curve:
+            logging.info("Average log likelihood per frame: {}.".format(
+                         ", ".join("{:.4f}".format(likelihood) for
+                                   likelihood in curve)))
 
     def small_pause(self, corpus):
         """
         Add in a tied-state small pause model
         """
+        if self._resumed("small_pause", corpus):
+            return
         # make new hmmdef
         saved = ['~h "{}"'.format(SP)]
+        # the current HMMs are left as they are, and a copy is extended
+        spdir = os.path.join(self.hmmdir, SP)
+        mkdir_p(spdir)
+        copyfile(os.path.join(self.curdir, HMMDEFS),
+                 os.path.join(spdir, HMMDEFS))
         # opened both for reading and writing
-        with open(os.path.join(self.curdir, HMMDEFS), "r+") as hmmdefs:
+        with open(os.path.join(spdir, HMMDEFS), "r+") as hmmdefs:
             # find SIL
             for line in hmmdefs:
                 if line.startswith('~h "{}"'.format(SIL)):
@@ -183,83 +472,196 @@ AT 4 2 0.2 {{{1}.transP}}
 AT 1 3 0.3 {{{0}.transP}}
 TI silst {{{1}.state[3],{0}.state[2]}}
 """.format(SP, SIL), file=hed)
-        check_call(["HHEd", "-H", os.path.join(self.curdir, MACROS),
-                            "-H", os.path.join(self.curdir, HMMDEFS),
-                            "-M", self.nxtdir,
-                            temp, corpus.phons])
+        with metrics.stage("HHEd"):
+            self.runner.run(["HHEd", "-H", os.path.join(self.curdir, MACROS),
+                                     "-H", os.path.join(spdir, HMMDEFS),
+                                     "-M", self.nxtdir,
+                                     temp, corpus.phons])
         temp = os.path.join(self.hmmdir, TEMP)
         with open(temp, "w") as led:
             print("""EX
 IS {0} {0}
 """.format(SIL), file=led)
-        check_call(["HLEd", "-l", corpus.auddir,
-                            "-d", corpus.taskdict,
-                            "-i", corpus.phon_mlf,
-                            temp, corpus.word_mlf])
+        with metrics.stage("HLEd", items=len(corpus.audiofiles)):
+            self.runner.run(["HLEd", "-l", "*",
+                                     "-d", corpus.taskdict,
+                                     "-i", corpus.phon_mlf,
+                                     temp, corpus.word_mlf])
         logging.debug("(Skipping an iteration number).")
         self._nxtdir()
+        self._checkpoint("small_pause", corpus, saved=("phon_mlf",))
+
+    def write_binary(self, dirname):
+        """
+        Write the current HMMs to `dirname` in HTK's binary format, which
+        is much faster for the HTK tools to load than the text format
+        """
+        hmmdefs = os.path.join(self.curdir, HMMDEFS)
+        # e.g., if read from a binary archive, there is nothing to convert
+        # (and no names to read from the HMM definitions)
+        if _is_binary(hmmdefs):
+            for filename in (HMMDEFS, MACROS):
+                copyfile(os.path.join(self.curdir, filename),
+                         os.path.join(dirname, filename))
+            return
+        # the HMM list is just the names of the HMMs defined
+        hmmlist = os.path.join(self.hmmdir, "hmmlist")
+        with open(hmmdefs, "r") as source, open(hmmlist, "w") as sink:
+            for line in source:
+                m = match(r'~h "(.+)"', line)
+                if m:
+                    print(m.group(1), file=sink)
+        # an empty edit script
+        temp = os.path.join(self.hmmdir, TEMP)
+        open(temp, "w").close()
+        with metrics.stage("HHEd"):
+            self.runner.run(["HHEd", "-B",
+                                     "-H", os.path.join(self.curdir, MACROS),
+                                     "-H", hmmdefs,
+                                     "-M", dirname,
+                                     temp, hmmlist])
+
+    def _HVite(self, corpus, scp, word_mlf, outdir):
+        """
+        Construct the HVite command line for aligning the feature files
+        listed in `scp` against the transcripts in `word_mlf`, writing a
+        label file for each to `outdir`
+        """
+        return (["HVite", "-a", "-m",
+                          "-T", "1",
+                          "-o", "SM",
+                          "-y", "lab",
+                          "-b", SIL,
+                          "-l", outdir,
+                          "-C", self.HERest_cfg,
+                          "-S", scp,
+                          "-H", os.path.join(self.curdir, MACROS),
+                          "-H", os.path.join(self.curdir, HMMDEFS),
+                          "-I", word_mlf,] +
+                          #FIXME(kg) do we want this?
+                          #"-s", str(self.HVite_opts["SFAC"]),
+                          #"-t"] + self.pruning +
+                [corpus.taskdict, corpus.phons])
+
+    def _align_shard(self, corpus, indices, scp, word_mlf, mlf,
+                     finished=None):
+        """
+        Align a single shard, writing the result to `mlf`, and return a
+        list of (audiofile, score) pairs in the order of `indices`.
+
+        HVite writes a label file for each utterance, and reports in its
+        trace when it begins the next, so each utterance is added to `mlf`
+        (and passed to `finished`, if given, as `finished(audiofile, name,
+        lines, score)`) as soon as it is aligned, while HVite carries on
+        with the rest.
+        """
+        outdir = mkdtemp(dir=self.hmmdir)
+        positions = {splitname(corpus.featurefiles[i])[1]: i for i in
+                     indices}
+        scores = []
+
+        def finish(basename, score):
+            labfile = os.path.join(outdir, basename + ".lab")
+            try:
+                with open(labfile, "r") as source:
+                    lines = [line.rstrip() for line in source if
+                             line.strip()]
+            except FileNotFoundError:  # no alignment found
+                return
+            os.remove(labfile)
+            name = "*/{}.lab".format(basename)
+            print_block(name, lines, sink)
+            audiofile = corpus.audiofiles[positions[basename]]
+            if score is not None:
+                scores.append((audiofile, score))
+            if finished:
+                finished(audiofile, name, lines, score)
+
+        with open(mlf, "w") as sink:
+            print(MLF_HEADER, file=sink)
+            (basename, score) = (None, None)
+            with self.runner.stream(self._HVite(corpus, scp, word_mlf,
+                                                outdir)) as proc:
+                for line in proc.stdout:
+                    line = line.decode("UTF-8")
+                    m = match(HVITE_FILE, line)
+                    if m:
+                        # the previous utterance's label file is complete
+                        if basename:
+                            finish(basename, score)
+                        (basename, score) = (splitname(
+                                             m.group(1).strip())[1], None)
+                        continue
+                    m = match(HVITE_SCORE, line)
+                    if m:
+                        score = m.group(1)
+            if basename:
+                finish(basename, score)
+        rmtree(outdir)
+        return scores
+
+    def _align(self, corpus, mlf, finished=None):
+        """
+        Align the corpus, writing the result to `mlf`, and return a list of
+        (audiofile, score) pairs in the order of `corpus.audiofiles`; when
+        `self.shards` > 1, shards of the corpus are aligned concurrently,
+        and so `finished` (see `_align_shard`) must be thread-safe
+        """
+        if self.shards == 1:
+            return self._align_shard(corpus, range(len(corpus.audiofiles)),
+                                     corpus.feature_scp, corpus.word_mlf,
+                                     mlf, finished)
+        word_blocks = {splitname(name)[1]: (name, lines) for (name, lines)
+                       in read_mlf(corpus.word_mlf)}
+        shards = self._shards(corpus)
+        for (indices, prefix) in shards:
+            write_mlf(prefix + ".mlf", [word_blocks[corpus.names[i]]
+                                        for i in indices])
+        logging.debug("Aligning {} shards.".format(len(shards)))
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self._align_shard, corpus, indices,
+                                       prefix + ".scp", prefix + ".mlf",
+                                       prefix + ".aligned.mlf", finished)
+                       for (indices, prefix) in shards]
+            scores = [score for future in futures for score in
+                      future.result()]
+        # shards are contiguous, so concatenation restores corpus order
+        cat_mlf(mlf, [prefix + ".aligned.mlf" for (_, prefix) in shards])
+        return scores
 
     def align(self, corpus, mlf):
-        check_call(["HVite", "-a", "-m",
-                             "-o", "SM",
-                             "-y", "lab",
-                             "-b", SIL,
-                             "-i", mlf,
-                             "-L", corpus.labdir,
-                             "-C", self.HERest_cfg,
-                             "-S", corpus.feature_scp,
-                             "-H", os.path.join(self.curdir, MACROS),
-                             "-H", os.path.join(self.curdir, HMMDEFS),
-                             "-I", corpus.word_mlf,] +
-                             #FIXME(kg) do we want this?
-                             #"-s", str(self.HVite_opts["SFAC"]), 
-                             #"-t"] + self.pruning +
-                   [corpus.taskdict, corpus.phons], stdout=PIPE)
+        with metrics.stage("HVite", items=len(corpus.audiofiles)):
+            self._align(corpus, mlf)
 
     def realign(self, corpus):
         """
         Align and then overwrite `corpus.word_mlf` with the result
         """
+        if self._resumed("realign", corpus):
+            return
         temp = os.path.join(self.hmmdir, TEMP)
         self.align(corpus, temp)
         copyfile(temp, corpus.word_mlf)
+        self._checkpoint("realign", corpus, saved=("word_mlf",))
 
-    def align_and_score(self, corpus, mlf, scores):
+    def align_and_score(self, corpus, mlf, scores, callback=None):
         """
         The same as `self.align`, but also generates a text file `score`
-        with -log likelihood confidence scores for each audio file
-        """
-        proc = Popen(["HVite", "-a", "-m",
-                               "-T", "1",
-                               "-o", "SM",
-                               "-y", "lab",
-                               "-b", SIL,
-                               "-i", mlf,
-                               "-L", corpus.labdir,
-                               "-C", self.HERest_cfg,
-                               "-S", corpus.feature_scp,
-                               "-H", os.path.join(self.curdir, MACROS),
-                               "-H", os.path.join(self.curdir, HMMDEFS),
-                               "-I", corpus.word_mlf,] +
-                               #FIXME(kg) do we want this?
-                               #"-s", str(self.HVite_opts["SFAC"]),
-                               #"-t"] + self.pruning +
-                     [corpus.taskdict, corpus.phons],
-                     stdout=PIPE)
+        with -log likelihood confidence scores for each audio file (in the
+        order of `corpus.audiofiles`), and returns the number of files
+        aligned. If `callback` is given, `callback(audiofile, name, lines,
+        score)` is called (perhaps concurrently) with each label file as
+        soon as it is aligned.
+        """
+        with metrics.stage("HVite", items=len(corpus.audiofiles)):
+            scored = self._align(corpus, mlf, callback)
         with open(scores, "w") as sink:
-            i = 0
-            for line in proc.stdout:
-                m = match(HVITE_SCORE, line.decode("UTF-8"))
-                if m:
-                    print('"{!s}",{!s}'.format(corpus.audiofiles[i],
-                                               m.group(1)), file=sink)
-                    i += 1
-        # Popen equivalent to check_call...
-        retcode = proc.wait()
-        if retcode != 0:
-            raise CalledProcessError(retcode, proc.args)
+            for (audiofile, score) in scored:
+                print('"{!s}",{!s}'.format(audiofile, score), file=sink)
+        return len(scored)
 
     def HTKbook_training_regime(self, corpus, epochs, flatstart=True):
+        self._begin(corpus)
         if flatstart:
             logging.info("Flat start training.")
             self.flatstart(corpus)
@@ -274,4 +676,5 @@ IS {0} {0}
         self.train(corpus, epochs)
 
     def __del__(self):
-        rmtree(self.hmmdir)
+        if self.is_tmpdir:
+            rmtree(self.hmmdir)
@@ -0,0 +1,452 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Programmatic interface to the aligner
+
+    >>> from aligner.api import Model
+    >>> model = Model.read("eng.zip", "eng.dict", jobs=4)
+    >>> for dirname in dirnames:
+    ...     model.align(dirname)
+
+As with the command-line driver, errors in the data are reported by
+logging them and exiting, so callers processing many corpora in one
+process may wish to catch `SystemExit`.
+"""
+
+import os
+import json
+import logging
+import yaml
+
+from csv import reader
+from argparse import Namespace
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from . import metrics
+from .corpus import Corpus
+from .aligner import Aligner
+from .archive import Archive
+from .longaudio import LongAudio
+from .mlf import read_mlf, print_block, write_textgrid, MLF_HEADER
+from .prondict import PronDict
+from .runner import Runner
+from .table import Table
+from .utilities import splitname, mkdir_p, resolve_opts, \
+                       ALIGNED, CONFIG, DICTIONARY, FINGERPRINTS, HMMDEFS, \
+                       MACROS, METRICS, MODEL, RUNTIME_OPTIONS, SCORES
+
+
+# options which may be passed as keyword arguments, as on the command line
+OPTIONS = ("samplerate", "resampler", "channel", "epochs", "min_epochs",
+           "convergence_threshold", "jobs", "shards", "feature_cache",
+           "feature_cache_size", "workdir", "resume", "timeout", "retries",
+           "trace")
+
+
+def _report(dirname):
+    """
+    Log the stages recorded (see `metrics`) since the last alignment, and
+    write them to `dirname`
+    """
+    metrics.log()
+    metrics.write(os.path.join(dirname, METRICS))
+    logging.debug("Wrote metrics to '{}'.".format(dirname))
+
+
+def _resolve(configuration, dictionary, **options):
+    """
+    Resolve options as if they had been given on the command line
+    """
+    unknown = set(options) - set(OPTIONS)
+    if unknown:
+        raise TypeError("Unknown option(s): {}.".format(
+                        ", ".join(sorted(unknown))))
+    if dictionary is None:
+        dictionary = [DICTIONARY]
+    elif isinstance(dictionary, str):
+        dictionary = [dictionary]
+    args = Namespace(configuration=configuration,
+                     dictionary=list(dictionary),
+                     **{option: options.get(option) for option in OPTIONS})
+    return resolve_opts(args)
+
+
+class Model(object):
+
+    """
+    Class representing a trained aligner, together with its options and
+    pronunciation dictionary, which can be used to align any number of
+    corpora without reading them again
+    """
+
+    def __init__(self, aligner, opts, archive=None, cache=None):
+        self.aligner = aligner
+        self.opts = opts
+        # the aligner's HMMs live here, if it was read from disk
+        self.archive = archive
+        # compiled dictionaries are kept here (or in the feature cache, or
+        # failing that, the user's cache directory)
+        self.cache = cache
+        # the corpus most recently trained on, if any
+        self.corpus = None
+        self.corpus_dirname = None
+        self._thedict = None
+
+    def __repr__(self):
+        return "{}(aligner={!r}, archive={!r})".format(
+               self.__class__.__name__, self.aligner, self.archive)
+
+    @classmethod
+    def read(cls, source=MODEL, dictionary=None, cache=None, **options):
+        """
+        Read a model from an archive file or directory (or an `Archive`),
+        resolving `options` against the configuration stored therein; if
+        `cache` is given, archive files are unpacked there and reused
+        """
+        for option in ("samplerate", "epochs", "min_epochs",
+                       "convergence_threshold", "workdir", "resume"):
+            if options.pop(option, None):
+                logging.warning("Ignoring {} for persistent model.".format(
+                                option))
+        archive = source if isinstance(source, Archive) else \
+                  Archive(source, cache=cache)
+        opts = _resolve(os.path.join(archive.dirname, CONFIG), dictionary,
+                        **options)
+        aligner = Aligner(opts)
+        aligner.curdir = archive.dirname
+        return cls(aligner, opts, archive, cache)
+
+    @classmethod
+    def train(cls, dirname, configuration, dictionary=None, **options):
+        """
+        Train a model on the corpus in `dirname` (a directory or a
+        manifest), writing the metrics of training (see `metrics`) there
+        (or next to the manifest)
+        """
+        opts = _resolve(configuration, dictionary, **options)
+        logging.info("Preparing corpus '{}'.".format(dirname))
+        # one runner for all the HTK tools this model runs
+        runner = Runner.from_opts(opts)
+        corpus = Corpus(dirname, opts, runner=runner)
+        logging.info("Preparing aligner.")
+        aligner = Aligner(opts, runner)
+        logging.info("Training aligner on corpus '{}'.".format(dirname))
+        aligner.HTKbook_training_regime(corpus, opts["epochs"])
+        model = cls(aligner, opts)
+        model.corpus = corpus
+        model.corpus_dirname = os.path.realpath(dirname)
+        _report(dirname if os.path.isdir(dirname) else
+                os.path.dirname(os.path.abspath(dirname)))
+        return model
+
+    @property
+    def thedict(self):
+        """
+        The pronunciation dictionary, read on first use
+        """
+        if self._thedict is None:
+            self._thedict = PronDict(frozenset(self.opts["phoneset"]),
+                                     cachedir=self.cache or
+                                              self.opts["feature_cache"])
+            for dic in self.opts["dictionary"]:
+                self._thedict.add(dic)
+        return self._thedict
+
+    def _corpus(self, dirname, previous=None):
+        # no need to prepare the training data twice
+        if previous is None and \
+                self.corpus_dirname == os.path.realpath(dirname):
+            return self.corpus
+        logging.info("Preparing corpus '{}'.".format(dirname))
+        return Corpus(dirname, self.opts, self.thedict, previous,
+                      runner=self.aligner.runner)
+
+    def _previous(self, fingerprints, aligned, scores):
+        """
+        Read the fingerprints of the utterances aligned by an earlier run,
+        so long as they were aligned by this very model and its output is
+        still there
+        """
+        if not (os.path.exists(aligned) and os.path.exists(scores)):
+            return {}
+        try:
+            with open(fingerprints, "r") as source:
+                state = json.load(source)
+        except (OSError, ValueError):
+            return {}
+        if state.get("model") != self.aligner.digest():
+            logging.info("Model has changed since the last run.")
+            return {}
+        return state["utterances"]
+
+    def _merge(self, corpus, previous, aligned, scores):
+        """
+        Add the alignments and scores of utterances which were not aligned
+        again to those of the ones which were, in corpus order, writing the
+        TextGrids of the former if they have gone missing, and return the
+        number of utterances in the result
+        """
+        blocks = {}
+        old_scores = {}
+        if corpus.reused:
+            names = {previous[audiofile]["name"]: audiofile for audiofile in
+                     corpus.reused}
+            for (name, lines) in read_mlf(aligned):
+                name = splitname(name)[1]
+                if name in names:
+                    blocks[names[name]] = lines
+            with open(scores, "r") as source:
+                old_scores = {audiofile: score for (audiofile, score) in
+                              reader(source)}
+        new_blocks = {}
+        new_scores = {}
+        if corpus.audiofiles:
+            for (name, lines) in read_mlf(os.path.join(corpus.tmpdir,
+                                                       ALIGNED)):
+                new_blocks[splitname(name)[1]] = lines
+            with open(os.path.join(corpus.tmpdir, SCORES), "r") as source:
+                new_scores = {audiofile: score for (audiofile, score) in
+                              reader(source)}
+        # outputs are only consistent with the fingerprints once complete
+        fingerprints = os.path.join(os.path.dirname(aligned), FINGERPRINTS)
+        if os.path.exists(fingerprints):
+            os.remove(fingerprints)
+        state = {}
+        with open(aligned, "w") as mlf, open(scores, "w") as sink:
+            print(MLF_HEADER, file=mlf)
+            for (audiofile, entry) in corpus.state.items():
+                name = entry["name"]
+                if audiofile in corpus.reused:
+                    lines = blocks.get(audiofile)
+                    score = old_scores.get(audiofile)
+                else:
+                    lines = new_blocks.get(name)
+                    score = new_scores.get(audiofile)
+                if lines is None:  # not aligned
+                    continue
+                print_block("*/{}.lab".format(name), lines, mlf)
+                if score is not None:
+                    print('"{!s}",{!s}'.format(audiofile, score), file=sink)
+                if audiofile in corpus.reused:
+                    textgrid = corpus.textgrids[name]
+                    if not os.path.exists(textgrid):
+                        write_textgrid(name, lines, textgrid)
+                state[audiofile] = entry
+        with open(fingerprints, "w") as sink:
+            json.dump({"model": self.aligner.digest(), "utterances": state},
+                      sink)
+        return len(state)
+
+    def _align_long(self, dirname, long_audio, aligned, scores, table):
+        """
+        Align the recordings in `dirname` in chunks of at most `long_audio`
+        seconds (see `LongAudio`), and return the number aligned
+        """
+        logging.info("Splitting long recordings in '{}'.".format(dirname))
+        longaudio = LongAudio(dirname, long_audio, self.opts["channel"])
+        logging.info("Preparing corpus '{}'.".format(dirname))
+        corpus = Corpus(longaudio.manifest, self.opts, self.thedict,
+                        runner=self.aligner.runner)
+        logging.info("Aligning corpus '{}'.".format(dirname))
+        chunk_aligned = os.path.join(longaudio.dirname, ALIGNED)
+        chunk_scores = os.path.join(longaudio.dirname, SCORES)
+        self.aligner.align_and_score(corpus, chunk_aligned, chunk_scores)
+        longaudio.read(corpus, chunk_aligned, chunk_scores)
+        # align the words around each cut again, now anchored by the
+        # alignment of the chunks on either side
+        if longaudio.anchor():
+            logging.info("Aligning across cuts.")
+            seams = Corpus(longaudio.seam_manifest, self.opts,
+                           self.thedict, runner=self.aligner.runner)
+            seam_aligned = os.path.join(longaudio.dirname,
+                                        "seams" + ALIGNED)
+            self.aligner.align_and_score(seams, seam_aligned,
+                                         os.path.join(longaudio.dirname,
+                                                      "seams" + SCORES))
+            longaudio.read(seams, seam_aligned)
+        stitched = longaudio.stitch(aligned, scores)
+        logging.info("Writing TextGrids.")
+        for textgrid_dirname in frozenset(os.path.dirname(textgrid) for
+                                          textgrid in
+                                          longaudio.textgrids.values()):
+            mkdir_p(textgrid_dirname)
+        for (audiofile, name, lines, score) in stitched:
+            write_textgrid(name, lines,
+                           longaudio.textgrids[splitname(name)[1]])
+            if table:
+                table.add(audiofile, name, lines, score)
+        return len(stitched)
+
+    def _align_corpus(self, dirname, outdir, aligned, scores, table,
+                      incremental):
+        """
+        Align the corpus in `dirname` (incrementally, if `incremental` is
+        True), and return the number of files aligned
+        """
+        previous = None
+        if incremental:
+            previous = self._previous(os.path.join(outdir, FINGERPRINTS),
+                                      aligned, scores)
+        corpus = self._corpus(dirname, previous)
+        for textgrid_dirname in frozenset(os.path.dirname(textgrid) for
+                                          textgrid in
+                                          corpus.textgrids.values()):
+            mkdir_p(textgrid_dirname)
+        logging.info("Aligning corpus '{}'.".format(dirname))
+
+        # TextGrids are written as soon as each file is aligned
+        def finished(audiofile, name, lines, score):
+            write_textgrid(name, lines,
+                           corpus.textgrids[splitname(name)[1]])
+
+        if not incremental:
+            size = self.aligner.align_and_score(corpus, aligned, scores,
+                                                finished)
+        else:
+            if corpus.audiofiles:
+                self.aligner.align_and_score(corpus,
+                                             os.path.join(corpus.tmpdir,
+                                                          ALIGNED),
+                                             os.path.join(corpus.tmpdir,
+                                                          SCORES),
+                                             finished)
+            size = self._merge(corpus, previous, aligned, scores)
+        if table:
+            self._tabulate(corpus, aligned, scores, table)
+        return size
+
+    def _tabulate(self, corpus, aligned, scores, table):
+        """
+        Add the alignments in `aligned` and the scores in `scores` to
+        `table`, so that its rows are in corpus order whatever order the
+        files were aligned in
+        """
+        if corpus.state is not None:
+            audiofiles = {entry["name"]: audiofile for (audiofile, entry) in
+                          corpus.state.items()}
+        else:
+            audiofiles = dict(zip(corpus.names, corpus.audiofiles))
+        with open(scores, "r") as source:
+            file_scores = dict(reader(source))
+        for (name, lines) in read_mlf(aligned):
+            audiofile = audiofiles[splitname(name)[1]]
+            table.add(audiofile, name, lines, file_scores.get(audiofile))
+
+    def align(self, dirname, long_audio=None, table=None,
+              incremental=False):
+        """
+        Align the corpus in `dirname` (a directory or a manifest; see
+        `Corpus`), writing the alignments, scores, and metrics (see
+        `metrics`) there (or next to the manifest) and each TextGrid next
+        to its audio file (or wherever the manifest says), and return the
+        number of TextGrids written; if `long_audio` is given, recordings
+        longer than that many seconds are aligned in chunks, and if
+        `table` is given, all the intervals (with scores) are also written
+        to that file (see `Table`), in corpus order. If `incremental` is True, fingerprints
+        of the utterances are kept with the scores, and only those which
+        are new or have changed since the last (incremental) run are
+        prepared and aligned again
+        """
+        if long_audio and incremental:
+            logging.error("Long audio cannot be aligned incrementally.")
+            exit(1)
+        if os.path.isdir(dirname):
+            outdir = dirname
+        else:
+            (outdir, _) = os.path.split(os.path.abspath(dirname))
+        if table:
+            table = Table(table)
+        aligned = os.path.join(outdir, ALIGNED)
+        scores = os.path.join(outdir, SCORES)
+        # the table is closed even if alignment fails, so it stays readable
+        try:
+            if long_audio:
+                size = self._align_long(dirname, long_audio, aligned,
+                                        scores, table)
+            else:
+                size = self._align_corpus(dirname, outdir, aligned, scores,
+                                          table, incremental)
+        finally:
+            if table:
+                table.close()
+        if table:
+            logging.debug("Wrote table to '{}'.".format(table.filename))
+        # stages since the last alignment (including any training)
+        _report(outdir)
+        metrics.reset()
+        logging.debug("Wrote MLF file to '{}'.".format(aligned))
+        logging.debug("Wrote likelihood scores to '{}'.".format(scores))
+        logging.debug("Wrote {} TextGrids.".format(size))
+        return size
+
+    def write(self, filename, binary=False):
+        """
+        Write the model to an archive, returning its name; if `binary` is
+        True, the HMMs are stored in HTK's binary format. The metrics of
+        the stages run since the last alignment (e.g., training) are
+        written next to the archive
+        """
+        (_, basename, _) = splitname(filename)
+        archive = Archive.empty(basename)
+        hmmdir = self.aligner.curdir
+        if binary:
+            hmmdir = mkdtemp(dir=os.environ.get("TMPDIR", None))
+            self.aligner.write_binary(hmmdir)
+        archive.add(os.path.join(hmmdir, HMMDEFS))
+        archive.add(os.path.join(hmmdir, MACROS))
+        if binary:
+            rmtree(hmmdir)
+        opts = dict(self.opts)
+        # whatever this is, it's not going to work once you move the data
+        if "dictionary" in opts:
+            del opts["dictionary"]
+        # nor are settings specific to this machine
+        for key in RUNTIME_OPTIONS:
+            if key in opts:
+                del opts[key]
+        with open(os.path.join(archive.dirname, CONFIG), "w") as sink:
+            yaml.dump(opts, sink)
+        (basename, _) = os.path.splitext(filename)
+        archive_path = archive.dump(basename)
+        # stages since the last alignment, if any (including training)
+        _report(os.path.dirname(os.path.abspath(archive_path)))
+        return archive_path
+
+
+def align(dirname, model=MODEL, dictionary=None, long_audio=None,
+          table=None, incremental=False, **options):
+    """
+    Align the corpus in `dirname` using `model`, which is either a `Model`
+    or the name of an archive to read one from, returning the number of
+    TextGrids written (see `Model.align`)
+    """
+    if not isinstance(model, Model):
+        model = Model.read(model, dictionary, **options)
+    return model.align(dirname, long_audio, table, incremental)
+
+
+def train(dirname, configuration, dictionary=None, **options):
+    """
+    Train a model on the corpus in `dirname`, returning the `Model`
+    """
+    return Model.train(dirname, configuration, dictionary, **options)
@@ -24,39 +24,121 @@ Serialization/deserialization functionality using `shutil`
 """
 
 import os
+import json
+import logging
 
 from tempfile import mkdtemp
 from shutil import copy, rmtree, make_archive, unpack_archive
 
+from .cache import filehash
 from .utilities import mkdir_p
 
 
 # default format for output
 FORMAT = "zip"
 
+# checksums of the files unpacked into a model cache entry
+CHECKSUMS = "checksums.json"
+
+
+def _unpack(source, base):
+    """
+    Unpack an archive into `base`, returning the directory it contains
+    """
+    unpack_archive(source, base)
+    (head, tail, _) = next(os.walk(base))
+    if not tail:
+        raise ValueError("'{}' is empty.".format(source))
+    if len(tail) > 1:
+        raise ValueError("'{}' is a bomb.".format(source))
+    return os.path.join(head, tail[0])
+
+
+def _checksums(dirname):
+    """
+    Compute checksums for all files below `dirname`
+    """
+    checksums = {}
+    for (head, _, filenames) in os.walk(dirname):
+        for filename in filenames:
+            path = os.path.join(head, filename)
+            checksums[os.path.relpath(path, dirname)] = filehash(path)
+    return checksums
+
 
 class Archive(object):
 
     """
     Class representing data in a directory or archive file (zip, tar, 
-    tar.gz/tgz)
+    tar.gz/tgz); if `cache` is given, archive files are unpacked there,
+    keyed by their checksum, and later reused so long as the unpacked
+    files are intact
     """
 
-    def __init__(self, source, is_tmpdir=False):
+    def __init__(self, source, is_tmpdir=False, cache=None):
         if os.path.isdir(source):
             self.dirname = os.path.abspath(source)
             self.is_tmpdir = is_tmpdir  # trust caller
+        elif cache:
+            self.dirname = self._cached(source, cache)
+            self.is_tmpdir = False  # ignore caller
         else:
             base = mkdtemp(dir=os.environ.get("TMPDIR", None))
-            unpack_archive(source, base)
-            (head, tail, _) = next(os.walk(base))
-            if not tail:
-                raise ValueError("'{}' is empty.".format(source))
-            if len(tail) > 1:
-                raise ValueError("'{}' is a bomb.".format(source))
-            self.dirname = os.path.join(head, tail[0])
+            self.dirname = _unpack(source, base)
             self.is_tmpdir = True  # ignore caller
 
+    @staticmethod
+    def _verify(base):
+        """
+        Check the files unpacked in `base` against their checksums,
+        returning the directory they are in, or None if any are missing
+        or changed
+        """
+        try:
+            with open(os.path.join(base, CHECKSUMS), "r") as source:
+                checksums = json.load(source)
+            dirname = os.path.join(base, checksums["dirname"])
+            if _checksums(dirname) != checksums["files"]:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return dirname
+
+    @staticmethod
+    def _cached(source, cache):
+        """
+        Find (or, failing that, put) the contents of `source` in `cache`
+        """
+        base = os.path.join(os.path.abspath(cache), filehash(source))
+        dirname = Archive._verify(base)
+        if dirname:
+            logging.debug("Using cached copy of '{}'.".format(source))
+            return dirname
+        mkdir_p(cache)
+        # entries are directories, which `atomic_write` cannot handle, so
+        # are unpacked under a temporary name and renamed into place
+        temp = mkdtemp(dir=cache)
+        try:
+            dirname = _unpack(source, temp)
+            with open(os.path.join(temp, CHECKSUMS), "w") as sink:
+                json.dump({"dirname": os.path.basename(dirname),
+                           "files": _checksums(dirname)}, sink)
+        except Exception:
+            rmtree(temp)
+            raise
+        # remove any damaged entry
+        if os.path.exists(base):
+            rmtree(base, ignore_errors=True)
+        try:
+            os.rename(temp, base)
+        except OSError:  # beaten to it by another run
+            rmtree(temp)
+        dirname = Archive._verify(base)
+        if not dirname:
+            raise ValueError("Cannot cache '{}' in '{}'.".format(source,
+                                                                 cache))
+        return dirname
+
     @classmethod
     def empty(cls, head):
         """
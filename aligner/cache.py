@@ -0,0 +1,143 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Persistent feature cache
+"""
+
+import os
+import logging
+
+from hashlib import sha1
+from shutil import copyfile, copyfileobj
+
+from .utilities import atomic_write, mkdir_p
+
+
+# size of blocks read when hashing
+BLOCKSIZE = 1 << 20
+
+
+def filehash(filename):
+    """
+    Compute the SHA-1 digest of a file's contents, without reading the
+    entire file into memory
+    """
+    digest = sha1()
+    with open(filename, "rb") as source:
+        for block in iter(lambda: source.read(BLOCKSIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+
+    """
+    Class representing a directory of feature files which persists across
+    runs, keyed on the audio content, the HCopy configuration, and any
+    other `settings` used in converting the audio (e.g., samplerate), as
+    well as those given for each file (see `key`); once it grows larger
+    than `maxsize` bytes, the least recently used entries are evicted
+    """
+
+    def __init__(self, dirname, maxsize, HCopy_cfg, *settings):
+        self.dirname = os.path.abspath(dirname)
+        mkdir_p(self.dirname)
+        self.maxsize = maxsize
+        self.salt = ":".join([filehash(HCopy_cfg)] +
+                             [str(setting) for setting in settings])
+
+    def __repr__(self):
+        return "{}(dirname={!r})".format(self.__class__.__name__,
+                                         self.dirname)
+
+    def key(self, audiofile, *settings):
+        """
+        Compute the cache key for an audio file, converted using `settings`
+        in addition to those common to all files
+        """
+        return sha1(":".join([filehash(audiofile), self.salt] +
+                             [str(setting) for setting in
+                              settings]).encode("UTF-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, key[:2], key + ".mfc")
+
+    def fetch(self, key, featurefile):
+        """
+        Link (or copy) the cached features for `key` to `featurefile`,
+        returning False if there are none
+        """
+        path = self.path(key)
+        try:
+            try:
+                os.link(path, featurefile)
+            except FileNotFoundError:
+                raise
+            except OSError:  # e.g., cache is on another filesystem
+                copyfile(path, featurefile)
+            # for LRU purposes, mtime is the time of last use
+            os.utime(path)
+        except FileNotFoundError:  # missing, or evicted by another run
+            return False
+        return True
+
+    def store(self, key, featurefile):
+        """
+        Add `featurefile` to the cache under `key`
+        """
+        path = self.path(key)
+        (dirname, _) = os.path.split(path)
+        mkdir_p(dirname)
+        with open(featurefile, "rb") as source, \
+             atomic_write(path, "wb") as sink:
+            copyfileobj(source, sink)
+
+    def evict(self, keep=frozenset()):
+        """
+        Remove least recently used entries, other than those whose keys
+        are in `keep`, until the cache is no larger than `self.maxsize`
+        """
+        entries = []
+        size = 0
+        for subdir in os.scandir(self.dirname):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                stat = entry.stat()
+                size += stat.st_size
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        if size <= self.maxsize:
+            return
+        entries.sort(key=lambda entry: entry[:2])
+        for (_, entry_size, entry) in entries:
+            (key, _) = os.path.splitext(entry.name)
+            if key in keep:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            if size <= self.maxsize:
+                break
+        logging.debug("Feature cache '{}' now {} bytes.".format(self.dirname,
+                                                                size))
@@ -25,41 +25,212 @@ Corpus utilities
 
 
 import os
+import json
 import logging
 
 from re import match
-from glob import glob
+from hashlib import sha1
 from shutil import rmtree
 from tempfile import mkdtemp
-from subprocess import check_call
+from concurrent.futures import ProcessPoolExecutor
 
-from .wavfile import WavFile
+from . import metrics
+from .cache import FeatureCache, filehash
+from .metrics import Metrics
+from .runner import Runner
+from .wavfile import WavFile, HTK_SAMPWIDTH, POLY, WAVE_FORMAT_PCM
 from .prondict import PronDict
 from .utilities import splitname, mkdir_p, opts2cfg, \
-                       MISSING, OOV, SIL, SP, TEMP
+                       MB, MISSING, OOV, SIL, SP, TEMP
 
 
 # regexp for inspecting phones
 VALID_PHONE = r"^[^\d\s]+[0-9]?$"
 
+# extensions of audio and label files
+WAV = ".wav"
+LAB = ".lab"
+TEXTGRID = ".TextGrid"
+
+# write buffer for the MLFs
+MLF_BUFFER = MB
+
+
+def _walk(dirname):
+    """
+    Pair up .wav and .lab files in `dirname` and all the directories
+    below it (other than hidden ones), scanning each directory just once,
+    and return a list of (audiofile, labelfile, TextGrid) triples, and a
+    list of files missing from pairs
+    """
+    triples = []
+    missing = []
+    stack = [dirname]
+    while stack:
+        head = stack.pop()
+        audiofiles = {}
+        labelfiles = {}
+        subdirs = []
+        with os.scandir(head) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                    continue
+                (stem, ext) = os.path.splitext(entry.name)
+                if ext == WAV:
+                    audiofiles[stem] = entry.path
+                elif ext == LAB:
+                    labelfiles[stem] = entry.path
+        for stem in sorted(audiofiles.keys() | labelfiles.keys()):
+            if stem not in labelfiles:
+                missing.append(os.path.join(head, stem + LAB))
+            elif stem not in audiofiles:
+                missing.append(os.path.join(head, stem + WAV))
+            else:
+                triples.append((audiofiles[stem], labelfiles[stem],
+                                os.path.join(head, stem + TEXTGRID)))
+        # depth-first, in order
+        stack.extend(sorted(subdirs, reverse=True))
+    return (triples, missing)
+
+
+def _read_manifest(filename):
+    """
+    Read a manifest listing, one utterance per line, the paths of an audio
+    file and a transcript and, optionally, the TextGrid to be written,
+    separated by tabs (and relative to the manifest itself), and return a
+    list of (audiofile, labelfile, TextGrid) triples, and a list of files
+    missing from them
+    """
+    triples = []
+    missing = []
+    (head, _) = os.path.split(os.path.abspath(filename))
+    with open(filename, "r") as source:
+        for (i, line) in enumerate(source, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = [os.path.join(head, field) for field in
+                      line.split("\t")]
+            if len(fields) == 2:
+                (stem, _) = os.path.splitext(fields[0])
+                fields.append(stem + TEXTGRID)
+            if len(fields) != 3:
+                logging.error("Formatting error in manifest '{}' (ln. {}).".format(filename, i))
+                exit(1)
+            (audiofile, labelfile, _) = fields
+            for path in (audiofile, labelfile):
+                if not os.path.isfile(path):
+                    missing.append(path)
+            triples.append(tuple(fields))
+    return (triples, missing)
+
+
+def discover(dirname, reportdir=os.curdir):
+    """
+    Return a list of (audiofile, labelfile, TextGrid) triples for the
+    directory tree (see `_walk`) or manifest (see `_read_manifest`)
+    `dirname`, exiting if any files are missing from pairs (which are
+    listed in `reportdir`) or if there are none at all
+    """
+    if os.path.isdir(dirname):
+        (triples, missing) = _walk(dirname)
+    else:
+        (triples, missing) = _read_manifest(dirname)
+    if missing:
+        report = os.path.join(reportdir, MISSING)
+        with open(report, "w") as sink:
+            for filename in missing:
+                print(filename, file=sink)
+        logging.error("Missing data files: see '{}'.".format(report))
+        exit(1)
+    if not triples:
+        logging.error("No .wav and .lab files in '{}'.".format(dirname))
+        exit(1)
+    return triples
+
+
+def unique_names(audiofiles):
+    """
+    Give each audio file a name, its basename if possible; HTK identifies
+    files by basename, which need not be unique
+    """
+    names = []
+    seen = set()
+    for audiofile in audiofiles:
+        (_, name, _) = splitname(audiofile)
+        if name in seen:
+            (stem, i) = (name, 1)
+            while name in seen:
+                name = "{}_{}".format(stem, i)
+                i += 1
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _extract_shard(runner, HCopy_cfg, audio_scp, items, samplerate,
+                   channel=None, resampler=POLY):
+    """
+    Convert (where necessary) and compute audio features for a list of
+    (audiofile, wavfile, featurefile) triples, where `wavfile` is the
+    (possibly converted) copy of `audiofile` passed to HCopy (run by
+    `runner`), and return the metrics recorded (which would otherwise be
+    lost, if this is run in another process)
+    """
+    shard_metrics = Metrics()
+    converted = sum(wavfile != audiofile for (audiofile, wavfile, _) in
+                    items)
+    with shard_metrics.stage("resample", items=converted), \
+         open(audio_scp, "w") as sink:
+        for (audiofile, wavfile, featurefile) in items:
+            if wavfile != audiofile:
+                logging.warning("Converting '{}'.".format(audiofile))
+                WavFile.resample_file(audiofile, wavfile, samplerate,
+                                      channel, resampler)
+            print('"{}" "{}"'.format(wavfile, featurefile), file=sink)
+    with shard_metrics.stage("HCopy", items=len(items)):
+        runner.run(["HCopy", "-C", HCopy_cfg, "-S", audio_scp])
+    return shard_metrics.stages
+
 
 class Corpus(object):
 
     """
     Class representing directory of training data; once constructed, it
-    is ready for training or aligning.
+    is ready for training or aligning. The data are the pairs of .wav and
+    .lab files in `dirname` and any directories below it, or, if
+    `dirname` is a file, those listed in it (see `_read_manifest`). A
+    `PronDict` which has already been loaded can be passed as `thedict` to
+    avoid reading the dictionaries again.
+
+    If `previous` is given (see `_select`), utterances which have not
+    changed since an earlier run are set aside in `self.reused`, and only
+    the rest are prepared; `self.state` then has the fingerprints of every
+    utterance, for the next run.
+
+    Missing data files and OOV words are listed in `reportdir`, and the
+    HTK tools are run by `runner` (by default, one configured by `opts`).
     """
 
-    def __init__(self, dirname, opts):
+    def __init__(self, dirname, opts, thedict=None, previous=None,
+                 reportdir=os.curdir, runner=None):
+        self.reportdir = reportdir
+        self.runner = runner or Runner.from_opts(opts)
         # temporary directories for stashing the data
         tmpdir = os.environ["TMPDIR"] if "TMPDIR" in os.environ else None
         self.tmpdir = mkdtemp(dir=tmpdir)
         self.auddir = os.path.join(self.tmpdir, "audio")
         mkdir_p(self.auddir)
-        self.labdir = os.path.join(self.tmpdir, "label")
-        mkdir_p(self.labdir)
         # samplerate
         self.samplerate = opts["samplerate"]
+        self.resampler = opts["resampler"]
+        self.channel = opts["channel"]
+        # parallelism
+        self.jobs = opts["jobs"]
+        self.shards = opts["shards"]
         # phoneset
         self.phoneset = frozenset(opts["phoneset"])
         for phone in self.phoneset:
@@ -72,10 +243,16 @@ class Corpus(object):
         if "dictionary" in opts and opts["dictionary"]:
             assert type(opts["dictionary"]) is list
             self.dictionary.extend(opts["dictionary"])
-        self.thedict = PronDict(self.phoneset)
-        for dic in self.dictionary:
-            self.thedict.add(dic)
+        if thedict is None:
+            thedict = PronDict(self.phoneset,
+                               cachedir=opts.get("feature_cache"))
+            for dic in self.dictionary:
+                thedict.add(dic)
+        else:  # already loaded, possibly for an earlier corpus
+            thedict.oov.clear()
+        self.thedict = thedict
         #self.thedict[SIL] = [SIL]
+        self.prundict = os.path.join(self.tmpdir, "prundict")
         self.taskdict = os.path.join(self.tmpdir, "taskdict")
         # word and phone lists
         self.phons = os.path.join(self.tmpdir, "phons")
@@ -87,142 +264,268 @@ class Corpus(object):
         # feature extraction configuration
         self.HCopy_cfg = os.path.join(self.tmpdir, "HCopy.cfg")
         opts2cfg(self.HCopy_cfg, opts["HCopy"])
+        # everything other than the audio itself which the features depend on
+        self.feature_settings = [filehash(self.HCopy_cfg), self.samplerate,
+                                 self.channel, self.resampler]
         self.audio_scp = os.path.join(self.tmpdir, "audio.scp")
         self.feature_scp = os.path.join(self.tmpdir, "feature.scp")
+        # persistent feature cache
+        self.cache = None
+        if opts["feature_cache"]:
+            self.cache = FeatureCache(opts["feature_cache"],
+                                      opts["feature_cache_size"] * MB,
+                                      self.HCopy_cfg, self.samplerate,
+                                      self.resampler)
         # prepare the data for processing
-        (audiofiles, labelfiles) = self._lists(dirname)
-        self.audiofiles = audiofiles
-        self._prepare_label(labelfiles)
-        self._prepare_audio(audiofiles)
+        self._lists(dirname)
+        self.state = None
+        self.reused = frozenset()
+        if previous is not None:
+            self._select(previous)
+            if not self.audiofiles:
+                return
+        with metrics.stage("labels", items=len(self.labelfiles)):
+            self._prepare_label(self.labelfiles)
+        self._prepare_audio(self.audiofiles)
         self._extract_features()
 
     def _lists(self, dirname):
         """
-        Create lists of .wav and .lab files, detecting missing pairs.
+        Create lists of .wav and .lab files, and of the TextGrids to be
+        written for them, detecting missing pairs, and give each pair a
+        unique name
         """
-        audiofiles = glob(os.path.join(dirname, "*.wav"))
-        labelfiles = glob(os.path.join(dirname, "*.lab"))
-        if not audiofiles:
-            logging.error("No .wav files in '{}'.".format(dirname))
-            exit(1)
-        elif not labelfiles:
-            logging.error("No .lab files in '{}'.".format(dirname))
-            exit(1)
-        audiobasenames = frozenset(splitname(audiofile)[1] for
-                                   audiofile in audiofiles)
-        labelbasenames = frozenset(splitname(labelfile)[1] for
-                                   labelfile in labelfiles)
-        missing = []
-        missing.extend(basename + ".wav" for basename in
-                       labelbasenames - audiobasenames)
-        missing.extend(basename + ".lab" for basename in
-                       audiobasenames - labelbasenames)
-        if missing:
-            with open(MISSING, "w") as sink:
-                for filename in missing:
-                    print(os.path.join(dirname, filename), file=sink)
-            logging.error("Missing data files: see '{}'.".format(MISSING))
-            exit(1)
-        return (audiofiles, labelfiles)
+        (self.audiofiles, self.labelfiles, textgrids) = \
+            (list(files) for files in zip(*discover(dirname,
+                                                     self.reportdir)))
+        self.names = unique_names(self.audiofiles)
+        # TextGrids to write, by name
+        self.textgrids = dict(zip(self.names, textgrids))
+
+    def _select(self, previous):
+        """
+        Fingerprint each utterance by the contents of its audio, the
+        settings used to extract its features, its words, and their
+        pronunciations, and set aside those whose fingerprints
+        match the entries for the same audio files in `previous` (the
+        `state` of an earlier corpus), so that only the utterances which
+        are new or have changed are prepared
+        """
+        self.state = {}
+        reused = set()
+        kept = []
+        for (i, (audiofile, labelfile)) in enumerate(zip(self.audiofiles,
+                                                         self.labelfiles)):
+            earlier = previous.get(audiofile)
+            stat = os.stat(audiofile)
+            audio = [stat.st_size, stat.st_mtime_ns]
+            # audio is only hashed again if it appears to have changed
+            if earlier and earlier["audio"][:2] == audio:
+                audio.append(earlier["audio"][2])
+            else:
+                audio.append(filehash(audiofile))
+            with open(labelfile, "r") as source:
+                words = source.readline().split()
+            prons = [(word, self.thedict[word] if word in self.thedict else
+                      None) for word in words]
+            digest = sha1(json.dumps([audio[2], self.feature_settings,
+                                      prons]).encode("UTF-8"))
+            self.state[audiofile] = {"name": self.names[i], "audio": audio,
+                                     "fingerprint": digest.hexdigest()}
+            if earlier and earlier["fingerprint"] == \
+                    self.state[audiofile]["fingerprint"]:
+                reused.add(audiofile)
+            else:
+                kept.append(i)
+        self.reused = frozenset(reused)
+        logging.info("{} of {} utterances unchanged.".format(len(reused),
+                     len(self.state)))
+        self.audiofiles = [self.audiofiles[i] for i in kept]
+        self.labelfiles = [self.labelfiles[i] for i in kept]
+        self.names = [self.names[i] for i in kept]
 
     def _prepare_label(self, labelfiles):
         """
-        Check label files against dictionary, and construct new .lab
-        and .mlf files
+        Check label files against dictionary, and construct word and phone
+        .mlf files, in a single pass and without writing any per-file
+        labels; the phone labels are the first pronunciation of each word,
+        with silence at either end, just as HLEd would produce
         """
         found_words = set()
-        with open(self.word_mlf, "w") as word_mlf:
+        with open(self.word_mlf, "w", buffering=MLF_BUFFER) as word_mlf, \
+             open(self.phon_mlf, "w", buffering=MLF_BUFFER) as phon_mlf:
             print("#!MLF!#", file=word_mlf)
-            for labelfile in labelfiles:
-                (_, filename) = os.path.split(labelfile)
-                phon_labfile = os.path.join(self.auddir, filename)
-                word_labfile = os.path.join(self.labdir, filename)
-                # header for each file in the .mlf
-                print('"{}"'.format(word_labfile), file=word_mlf)
+            print("#!MLF!#", file=phon_mlf)
+            for (name, labelfile) in zip(self.names, labelfiles):
                 # read in words from original .lab file
                 with open(labelfile, "r") as orig_handle:
                     words = orig_handle.readline().split()
                 found_words.update(words)
-                # write out new wordlab
-                with open(word_labfile, "w") as word_handle:
-                    print("\n".join(words), file=word_handle)
                 # get pronunciation and check for in-dictionary-hood
-                phons = []
+                phons = [SIL]
                 for word in words:
                     try:
                         phons.extend(self.thedict[word][0])
                     except (KeyError, IndexError):
                         pass
-                # write out new phonelab
-                with open(phon_labfile, "w") as phon_handle:
-                    print("\n".join(phons), file=phon_handle)
-                # append to word_mlf
-                print("\n".join(words), file=word_mlf)
-                print(".", file=word_mlf)
+                phons.append(SIL)
+                # the same pattern matches the label file wherever HTK
+                # looks for it
+                header = '"*/{}.lab"'.format(name)
+                word_mlf.write("\n".join([header] + words + ["."]) + "\n")
+                phon_mlf.write("\n".join([header] + phons + ["."]) + "\n")
         # report and die if OOV words are found
         if self.thedict.oov:
-            with open(OOV, "w") as oov:
+            report = os.path.join(self.reportdir, OOV)
+            with open(report, "w") as oov:
                 print("\n".join(sorted(self.thedict.oov)), file=oov)
-            logging.error("OOV word(s): see '{}'.".format(OOV))
+            logging.error("OOV word(s): see '{}'.".format(report))
             exit(1)
         # make words
         with open(self.words, "w") as words:
             print("\n".join(found_words), file=words)
+        # make a (sorted) dictionary of just those words, so that HDMan
+        # need not scan the full dictionaries
+        with open(self.prundict, "w") as prundict:
+            for word in sorted(found_words):
+                prons = []
+                for pron in self.thedict[word]:
+                    if pron not in prons:
+                        prons.append(pron)
+                for pron in prons:
+                    print("{} {}".format(word, " ".join(pron)), file=prundict)
         # create temp file to abuse
         temp = os.path.join(self.tmpdir, TEMP)
         # run HDMan
         with open(temp, "w") as ded:
             print("""AS {0}\nMP {1} {1} {0}
 """.format(SP, SIL), file=ded)
-        check_call(["HDMan", "-m",
-                             "-g", temp,
-                             "-w", self.words,
-                             "-n", self.phons,
-                             self.taskdict] +
-                   self.dictionary)
+        with metrics.stage("HDMan", items=len(found_words)):
+            self.runner.run(["HDMan", "-m",
+                                      "-g", temp,
+                                      "-w", self.words,
+                                      "-n", self.phons,
+                                      self.taskdict, self.prundict])
         # add SIL to phone list
         with open(self.phons, "a") as phons:
             print(SIL, file=phons)
         # add SIL to taskdict
         with open(self.taskdict, "a") as taskdict:
             print("{0} {0}".format(SIL), file=taskdict)
-        # run HLEd
-        with open(temp, "w") as led:
-            print("""EX
-IS {0} {0}
-DE {1}
-""".format(SIL, SP), file=led)
-        check_call(["HLEd", "-l", self.labdir,
-                            "-d", self.taskdict,
-                            "-i", self.phon_mlf,
-                            temp, self.word_mlf])
 
     def _prepare_audio(self, audiofiles):
         """
-        Check audio files, downsampling if necessary, creating .scp file
+        Check audio file headers, noting those which need to be resampled
+        or otherwise converted and those whose features are not already in
+        the cache, and create .scp file
         """
-        with open(self.audio_scp, "w") as audio_scp, \
-                open(self.feature_scp, "w") as feature_scp:
-            for audiofile in audiofiles:
-                (_, filename) = os.path.split(audiofile)
-                (basename, _) = os.path.splitext(filename)
-                featurefile = os.path.join(self.auddir, basename + ".mfc")
-                Fs = WavFile.samplerate(audiofile)
-                if Fs != self.samplerate:
-                    w = WavFile.from_file(audiofile)
-                    new_wav = os.path.join(self.auddir, filename)
-                    logging.warning("Resampling '{}'.".format(audiofile))
-                    w.resample_bang(self.samplerate)
-                    w.write(new_wav)
-                print('"{}" "{}"'.format(audiofile, featurefile),
-                      file=audio_scp)
+        self.wavfiles = []
+        self.featurefiles = []
+        self.durations = []
+        self.keys = []
+        self.pending = []
+        # (audiofile, # of channels) for files lacking the requested channel
+        no_channel = []
+        with open(self.feature_scp, "w") as feature_scp:
+            for (i, (name, audiofile)) in enumerate(zip(self.names,
+                                                        audiofiles)):
+                featurefile = os.path.join(self.auddir, name + ".mfc")
+                # only the header is read here
+                info = WavFile.info(audiofile)
+                # the channel is only selected from multichannel audio
+                channel = self.channel if info.channels > 1 else None
+                if channel is not None and \
+                        not 0 <= channel < info.channels:
+                    no_channel.append((audiofile, info.channels))
+                if info.samplerate != self.samplerate or \
+                        info.channels != 1 or \
+                        info.sampwidth != HTK_SAMPWIDTH or \
+                        info.format != WAVE_FORMAT_PCM:
+                    # converted copy is made during feature extraction
+                    self.wavfiles.append(os.path.join(self.auddir,
+                                                      name + WAV))
+                else:
+                    self.wavfiles.append(audiofile)
+                self.featurefiles.append(featurefile)
+                self.durations.append(info.nframes / info.samplerate)
                 print('"{}"'.format(featurefile), file=feature_scp)
+                if self.cache:
+                    key = self.cache.key(audiofile, channel)
+                    self.keys.append(key)
+                    if self.cache.fetch(key, featurefile):
+                        continue
+                self.pending.append(i)
+        if no_channel:
+            for (audiofile, channels) in no_channel:
+                logging.error("No channel {} in '{}' ({} channels).".format(
+                              self.channel, audiofile, channels))
+            exit(1)
+        if self.cache:
+            logging.info("Found features for {} of {} files in cache.".format(
+                         len(audiofiles) - len(self.pending),
+                         len(audiofiles)))
 
     def _extract_features(self):
         """
-        Compute audio features
+        Compute audio features for files not found in the cache; when the
+        corpus is split into more than one shard, shards are resampled and
+        passed to HCopy in parallel
+        """
+        items = [(self.audiofiles[i], self.wavfiles[i], self.featurefiles[i])
+                 for i in self.pending]
+        if not items:
+            pass
+        elif self.shards == 1:
+            metrics.merge(_extract_shard(self.runner, self.HCopy_cfg,
+                                         self.audio_scp, items,
+                                         self.samplerate, self.channel,
+                                         self.resampler))
+        else:
+            sharddir = os.path.join(self.tmpdir, "shards")
+            mkdir_p(sharddir)
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(_extract_shard, self.runner,
+                                           self.HCopy_cfg,
+                                           os.path.join(sharddir,
+                                                        str(k).zfill(3) +
+                                                        ".scp"),
+                                           [items[j] for j in shard],
+                                           self.samplerate, self.channel,
+                                           self.resampler)
+                           for (k, shard) in
+                           enumerate(self.partition(self.shards,
+                                                    self.pending))]
+                for future in futures:
+                    metrics.merge(future.result())
+        if self.cache:
+            for i in self.pending:
+                self.cache.store(self.keys[i], self.featurefiles[i])
+            self.cache.evict(keep=frozenset(self.keys))
+
+    def partition(self, n, indices=None):
+        """
+        Split the corpus (or the subset of it given by `indices`) into at
+        most `n` contiguous shards of roughly equal total duration (and
+        thus number of frames), returning a list of lists of positions in
+        `indices` (by default, indices into `self.audiofiles`)
         """
-        check_call(["HCopy", "-C", self.HCopy_cfg, "-S", self.audio_scp])
+        durations = self.durations
+        if indices is not None:
+            durations = [durations[i] for i in indices]
+        total = sum(durations)
+        shards = []
+        shard = []
+        elapsed = 0.
+        for (i, duration) in enumerate(durations):
+            shard.append(i)
+            elapsed += duration
+            if len(shards) < n - 1 and \
+                    elapsed >= total * (len(shards) + 1) / n:
+                shards.append(shard)
+                shard = []
+        if shard:
+            shards.append(shard)
+        return shards
 
     def __del__(self):
         rmtree(self.tmpdir) 
@@ -0,0 +1,377 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Chunking of long recordings for alignment
+"""
+
+import os
+import csv
+import logging
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import argmin, convolve, cumsum, empty, float64, log10, \
+                  ones, percentile
+
+from .mlf import read_mlf, write_mlf, HTK_UNITS
+from .corpus import discover, unique_names
+from .wavfile import WavFile
+from .utilities import splitname, SIL, SP
+
+
+# energy is computed over frames of 10 ms...
+FRAMES_PER_SECOND = 100
+# ...and smoothed over 250 ms when looking for a quiet place to cut
+SMOOTHING = 25
+# chunks are cut no earlier than this fraction of the maximum duration
+MIN_FRACTION = .5
+# words aligned within this many seconds of a cut are aligned again
+SEAM = 10.
+
+
+def _spans(lines):
+    """
+    Return the indices of the first and last lines of each word (leaving
+    out silences) in a label file
+    """
+    spans = []
+    for (i, line) in enumerate(lines):
+        fields = line.split()
+        if fields[2] in (SIL, SP):
+            continue
+        if len(fields) == 4:  # phone which begins a word
+            spans.append([i, i])
+        elif spans:
+            spans[-1][1] = i
+    return spans
+
+
+class LongAudio(object):
+
+    """
+    Class representing a corpus (a directory or a manifest; see `Corpus`)
+    in which recordings longer than `max_duration` seconds have been split
+    into chunks which can be aligned independently (and in parallel), and
+    then stitched back together.
+
+    Each chunk is cut at the quietest point (by smoothed energy) in the
+    second half of the longest chunk allowed, and the transcript is first
+    split among chunks in proportion to the amount of speech (frames with
+    more than the median energy) in each. As this may put words next to a
+    cut in the wrong chunk, the alignment of the chunks then anchors a
+    second pass (see `anchor`), in which the words aligned within `SEAM`
+    seconds of each cut are aligned again, together, over the audio they
+    span, so that they are free to move across it.
+
+    Chunks, and the audio around each cut, are written to a private
+    temporary directory, and listed (along with the recordings short
+    enough to be aligned whole) in the manifests `manifest` and
+    `seam_manifest`, respectively.
+    """
+
+    def __init__(self, dirname, max_duration, channel=None):
+        tmpdir = os.environ["TMPDIR"] if "TMPDIR" in os.environ else None
+        self.dirname = mkdtemp(dir=tmpdir)
+        self.max_duration = max_duration
+        self.channel = channel
+        (self.audiofiles, labelfiles, textgrids) = \
+            (list(files) for files in zip(*discover(dirname)))
+        self.names = unique_names(self.audiofiles)
+        # TextGrids to write, by name
+        self.textgrids = dict(zip(self.names, textgrids))
+        # name -> (audiofile, info, words), for recordings which are split
+        self.recordings = {}
+        # name -> list of (audiofile, offset, nframes, first word, stop
+        # word) for each chunk, with offsets in samples
+        self.chunks = {}
+        # name -> {k: (first word, stop word, audiofile, offset)}, for the
+        # seam across the cut after the k-th chunk
+        self.seams = {}
+        # audiofile (of a chunk or a seam) -> aligned lines, and score
+        self.aligned = {}
+        self.scores = {}
+        self.manifest = os.path.join(self.dirname, "chunks.tsv")
+        self.seam_manifest = os.path.join(self.dirname, "seams.tsv")
+        with open(self.manifest, "w") as sink:
+            for (i, (name, audiofile, labelfile)) in enumerate(zip(
+                    self.names, self.audiofiles, labelfiles)):
+                (audiofile, labelfile) = (os.path.abspath(audiofile),
+                                          os.path.abspath(labelfile))
+                info = WavFile.info(audiofile)
+                if info.nframes / info.samplerate <= max_duration:
+                    self.chunks[name] = [(audiofile, 0, info.nframes, None,
+                                          None)]
+                    print("{}\t{}".format(audiofile, labelfile), file=sink)
+                    continue
+                # chunks of each recording get a directory of their own
+                chunkdir = os.path.join(self.dirname, str(i))
+                os.mkdir(chunkdir)
+                for (chunkfile, chunklabel) in self._split(audiofile,
+                                                           labelfile, name,
+                                                           info, chunkdir):
+                    print("{}\t{}".format(chunkfile, chunklabel), file=sink)
+
+    def _energy(self, audiofile, info):
+        """
+        Compute log energy for each frame of a wav file, reading it one
+        block at a time
+        """
+        frame = info.samplerate // FRAMES_PER_SECOND
+        n = info.nframes // frame
+        energy = empty(n, dtype=float64)
+        step = frame * FRAMES_PER_SECOND * 60  # one minute
+        for start in range(0, n * frame, step):
+            stop = min(start + step, n * frame)
+            signal = WavFile.read_mono(audiofile, start, stop, self.channel,
+                                       info)
+            frames = signal.reshape(-1, frame)
+            energy[start // frame:stop // frame] = \
+                10 * log10((frames ** 2).mean(axis=1) + 1e-10)
+        return energy
+
+    def _cuts(self, energy):
+        """
+        Choose frames at which to cut, including the first and last
+        """
+        max_frames = int(self.max_duration * FRAMES_PER_SECOND)
+        smoothed = convolve(energy, ones(SMOOTHING) / SMOOTHING, "same")
+        cuts = [0]
+        while len(energy) - cuts[-1] > max_frames:
+            lo = cuts[-1] + int(max_frames * MIN_FRACTION)
+            hi = cuts[-1] + max_frames
+            cuts.append(lo + int(argmin(smoothed[lo:hi])))
+        cuts.append(len(energy))
+        return cuts
+
+    def _write(self, filename, audiofile, info, start, stop, words):
+        """
+        Write samples [`start`, `stop`) of `audiofile` to the .wav file
+        `filename`, and `words` to the matching .lab file, and return the
+        names of both
+        """
+        signal = WavFile.read_mono(audiofile, start, stop, self.channel,
+                                   info)
+        WavFile.write_mono(filename + ".wav", signal, info.samplerate)
+        with open(filename + ".lab", "w") as sink:
+            print(" ".join(words), file=sink)
+        return (filename + ".wav", filename + ".lab")
+
+    def _split(self, audiofile, labelfile, name, info, chunkdir):
+        """
+        Split a recording into chunks, written into `chunkdir`, and return
+        a list of the .wav and .lab files written
+        """
+        with open(labelfile, "r") as source:
+            words = source.readline().split()
+        energy = self._energy(audiofile, info)
+        cuts = self._cuts(energy)
+        if len(words) < len(cuts) - 1:
+            logging.warning("Too few words to split '{}'.".format(audiofile))
+            cuts = [0, len(energy)]
+        # split the transcript in proportion to the amount of speech
+        speech = cumsum(energy > percentile(energy, 50))
+        total = max(int(speech[-1]), 1)
+        bounds = [0]
+        for (i, cut) in enumerate(cuts[1:-1], 1):
+            k = int(round(speech[cut - 1] / total * len(words)))
+            # every chunk needs at least one word
+            k = max(k, bounds[-1] + 1)
+            k = min(k, len(words) - (len(cuts) - 1 - i))
+            bounds.append(k)
+        bounds.append(len(words))
+        frame = info.samplerate // FRAMES_PER_SECOND
+        self.recordings[name] = (audiofile, info, words)
+        self.chunks[name] = []
+        written = []
+        for (k, (start, stop)) in enumerate(zip(cuts, cuts[1:])):
+            # the last chunk runs to the end of the file
+            (start, stop) = (start * frame, stop * frame if
+                             stop < len(energy) else info.nframes)
+            (chunkfile, chunklabel) = self._write(
+                os.path.join(chunkdir, "{}_{}".format(name, str(k).zfill(4))),
+                audiofile, info, start, stop, words[bounds[k]:bounds[k + 1]])
+            self.chunks[name].append((chunkfile, start, stop - start,
+                                      bounds[k], bounds[k + 1]))
+            written.append((chunkfile, chunklabel))
+        logging.info("Split '{}' into {} chunks.".format(audiofile,
+                                                         len(cuts) - 1))
+        return written
+
+    def read(self, corpus, mlf, scores=None):
+        """
+        Read the alignments in `mlf` (and the scores in `scores`, if given)
+        of the chunks or seams in `corpus`, as aligned by `Aligner`
+        """
+        audiofiles = dict(zip(corpus.names, corpus.audiofiles))
+        for (name, lines) in read_mlf(mlf):
+            self.aligned[audiofiles[splitname(name)[1]]] = lines
+        if scores:
+            with open(scores, "r") as source:
+                for (audiofile, score) in csv.reader(source):
+                    self.scores[audiofile] = float(score)
+
+    def anchor(self):
+        """
+        For each cut between two aligned chunks, choose the words aligned
+        (by `read`) within `SEAM` seconds of it, write the audio they span
+        and their transcript to the temporary directory, list them in
+        `seam_manifest`, and return the number of seams written. Each seam
+        runs from the end of the word before the first chosen to the start
+        of the word after the last, and no two seams share a chunk's word
+        """
+        width = min(SEAM, self.max_duration * MIN_FRACTION / 4) * HTK_UNITS
+        size = 0
+        with open(self.seam_manifest, "w") as sink:
+            for (name, (audiofile, info, words)) in self.recordings.items():
+                self.seams[name] = {}
+                chunks = self.chunks[name]
+                units = HTK_UNITS / info.samplerate
+
+                # times of the words of each chunk, from the start of the
+                # recording, or None unless the chunk was aligned with
+                # the expected number of words
+                def times(chunk):
+                    (chunkfile, offset, _, first, stop) = chunk
+                    lines = self.aligned.get(chunkfile)
+                    if lines is None:
+                        return None
+                    spans = _spans(lines)
+                    if len(spans) != stop - first:
+                        return None
+                    return [(int(lines[a].split()[0]) + offset * units,
+                             int(lines[b].split()[1]) + offset * units) for
+                            (a, b) in spans]
+
+                right = times(chunks[0])
+                lo = chunks[0][3]
+                for (k, (left_chunk, right_chunk)) in \
+                        enumerate(zip(chunks, chunks[1:])):
+                    (left, right) = (right, times(right_chunk))
+                    (_, cut, nframes, first, right_stop) = right_chunk
+                    (_, _, _, left_first, left_stop) = left_chunk
+                    (lo, hi) = (max(lo, left_first), left_stop - 1)
+                    if left is None or right is None or lo > hi:
+                        lo = first
+                        continue
+                    cut *= units
+                    # first word to align again, on the left...
+                    i = next((w for w in range(lo, hi) if
+                              left[w - left_first][0] >= cut - width), hi)
+                    # ...and last, on the right
+                    j = next((w for w in reversed(range(first, right_stop))
+                              if right[w - first][1] <= cut + width), first)
+                    start = left_chunk[1] * units if i == left_first else \
+                            left[i - 1 - left_first][1]
+                    stop = cut + nframes * units if j + 1 == right_stop \
+                           else right[j + 1 - first][0]
+                    (start, stop) = (int(round(start / units)),
+                                     int(round(stop / units)))
+                    (seamfile, seamlabel) = self._write(
+                        os.path.join(self.dirname, "{}_seam{}".format(
+                                     name, str(k).zfill(4))),
+                        audiofile, info, start, stop, words[i:j + 1])
+                    print("{}\t{}".format(seamfile, seamlabel), file=sink)
+                    self.seams[name][k] = (i, j + 1, seamfile, start)
+                    size += 1
+                    # the next seam leaves at least one word of this chunk
+                    lo = j + 2
+        return size
+
+    def stitch(self, mlf, scores):
+        """
+        Combine the aligned chunks and seams (read by `read`) into a single
+        label file per recording, with times relative to the start of the
+        recording, written to `mlf`, and combine per-chunk scores
+        (weighting by duration) into `scores`; return a list of
+        (audiofile, name, lines, score) tuples, one per recording
+        """
+        stitched = []
+        with open(scores, "w") as sink:
+            for (name, audiofile) in zip(self.names, self.audiofiles):
+                info = self.recordings[name][1] if name in \
+                       self.recordings else None
+                seams = {k: seam for (k, seam) in
+                         self.seams.get(name, {}).items() if
+                         seam[2] in self.aligned}
+                # (offset, lines) for each piece, in order
+                pieces = []
+                (weighted, total) = (0., 0.)
+                for (k, (chunkfile, offset, nframes, first, stop)) in \
+                        enumerate(self.chunks[name]):
+                    if chunkfile not in self.aligned:
+                        # as with any utterance which fails to align, the
+                        # recording is left out, rather than leaving a gap
+                        if len(self.chunks[name]) > 1:
+                            start = offset / info.samplerate
+                            logging.warning("Chunk {} of '{}' (at {:.2f} s) "
+                                            "not aligned; skipping "
+                                            "recording.".format(k, audiofile,
+                                                                start))
+                        pieces = []
+                        break
+                    lines = self.aligned[chunkfile]
+                    (a, b) = (0, len(lines))
+                    # leave out the words aligned again in a seam
+                    if k - 1 in seams:
+                        seam_stop = seams[k - 1][1]
+                        a = len(lines) if seam_stop == stop else \
+                            _spans(lines)[seam_stop - first][0]
+                    if k in seams:
+                        seam_first = seams[k][0]
+                        b = 0 if seam_first == first else \
+                            _spans(lines)[seam_first - 1 - first][1] + 1
+                    pieces.append((offset, lines[a:b]))
+                    if k in seams:
+                        (_, _, seamfile, seam_offset) = seams[k]
+                        pieces.append((seam_offset, self.aligned[seamfile]))
+                    weighted += self.scores[chunkfile] * nframes
+                    total += nframes
+                lines = []
+                for (offset, piece) in pieces:
+                    shift = int(round(offset / info.samplerate *
+                                      HTK_UNITS)) if offset else 0
+                    for (i, line) in enumerate(piece):
+                        fields = line.split()
+                        fields[0] = str(int(fields[0]) + shift)
+                        fields[1] = str(int(fields[1]) + shift)
+                        # pieces meet where the last one ended
+                        if i == 0 and lines:
+                            fields[0] = lines[-1].split()[1]
+                        # merge the silences on either side of a cut
+                        if i == 0 and lines and fields[2] == SIL and \
+                                lines[-1].split()[2] == SIL:
+                            previous = lines[-1].split()
+                            previous[1] = fields[1]
+                            lines[-1] = " ".join(previous)
+                        else:
+                            lines.append(" ".join(fields))
+                if not lines:
+                    continue
+                score = weighted / total
+                stitched.append((audiofile, '*/{}.lab'.format(name), lines,
+                                 score))
+                print('"{!s}",{!s}'.format(audiofile, score), file=sink)
+        write_mlf(mlf, [(name, lines) for (_, name, lines, _) in stitched])
+        return stitched
+
+    def __del__(self):
+        rmtree(self.dirname)
@@ -0,0 +1,172 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Per-stage timing and resource use
+
+Stages are recorded in a default `Metrics` instance by the module-level
+functions, much as messages are logged by those of `logging`:
+
+    >>> from aligner import metrics
+    >>> with metrics.stage("HDMan", items=len(words)):
+    ...     self.runner.run(["HDMan", ...])
+"""
+
+import sys
+import json
+import time
+import logging
+
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from threading import Lock
+from contextlib import contextmanager
+
+
+# `ru_maxrss` is in kilobytes, except on macOS
+RSS_UNITS = 1 if sys.platform == "darwin" else 1024
+
+FIELDS = ("calls", "items", "seconds", "cpu_seconds", "child_cpu_seconds")
+
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+class Metrics(object):
+
+    """
+    Class accumulating, for each named stage, the number of times it was
+    run and of the items (e.g., files) processed, the wall-clock time, and
+    the CPU time of this process and of its (finished) child processes.
+
+    Stages may be run concurrently, but as CPU time is only available for
+    the process as a whole, that of concurrent stages is counted in each.
+    Peak memory use is likewise only available for the process as a whole
+    (and over its whole lifetime), so is written once, by `write`, rather
+    than for each stage.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+
+    def __repr__(self):
+        return "{}(stages={!r})".format(self.__class__.__name__,
+                                        list(self.stages))
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """
+        Record the stage `name`, which processes `items` items, while the
+        body of the `with` statement runs
+        """
+        start = time.perf_counter()
+        (usage, child_usage) = (getrusage(RUSAGE_SELF),
+                                getrusage(RUSAGE_CHILDREN))
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            (end_usage, end_child_usage) = (getrusage(RUSAGE_SELF),
+                                            getrusage(RUSAGE_CHILDREN))
+            record = {"calls": 1, "items": items, "seconds": seconds,
+                      "cpu_seconds": _cpu(end_usage) - _cpu(usage),
+                      "child_cpu_seconds": _cpu(end_child_usage) -
+                                           _cpu(child_usage)}
+            self.merge({name: record})
+
+    def merge(self, stages):
+        """
+        Add the records in `stages` (e.g., the `stages` of another
+        instance, perhaps from another process)
+        """
+        with self.lock:
+            for (name, record) in stages.items():
+                if name not in self.stages:
+                    self.stages[name] = dict.fromkeys(FIELDS, 0)
+                total = self.stages[name]
+                for field in FIELDS:
+                    total[field] += record[field]
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def report(self):
+        """
+        Return the records, in the order in which the stages first finished
+        """
+        with self.lock:
+            return {name: {field: round(value, 6) if
+                           isinstance(value, float) else value for
+                           (field, value) in record.items()}
+                    for (name, record) in self.stages.items()}
+
+    def log(self):
+        """
+        Log a summary of each stage
+        """
+        for (name, record) in self.report().items():
+            logging.debug("Stage '{}': {} call(s), {} item(s), {:.3f}s ({:.3f}s CPU, {:.3f}s in children).".format(
+                          name, record["calls"], record["items"],
+                          record["seconds"], record["cpu_seconds"],
+                          record["child_cpu_seconds"]))
+
+    def write(self, filename):
+        """
+        Write the records to `filename`, together with the peak resident
+        set size (in bytes) of this process, and of the largest of its
+        finished child processes, since it started
+        """
+        with open(filename, "w") as sink:
+            json.dump({"stages": self.report(),
+                       "peak_rss": getrusage(RUSAGE_SELF).ru_maxrss *
+                                   RSS_UNITS,
+                       "peak_child_rss": getrusage(RUSAGE_CHILDREN).ru_maxrss *
+                                         RSS_UNITS}, sink, indent=2)
+
+
+# the default instance
+_metrics = Metrics()
+
+
+def stage(name, items=0):
+    return _metrics.stage(name, items)
+
+
+def merge(stages):
+    _metrics.merge(stages)
+
+
+def reset():
+    _metrics.reset()
+
+
+def report():
+    return _metrics.report()
+
+
+def log():
+    _metrics.log()
+
+
+def write(filename):
+    _metrics.write(filename)
@@ -0,0 +1,184 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Master label file (MLF) utilities
+"""
+
+import os
+
+from re import match
+from shutil import copyfileobj
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from textgrid import IntervalTier, TextGrid
+
+from . import metrics
+
+
+MLF_HEADER = "#!MLF!#"
+MLF_NAME = r'^"(.*)"$'
+MLF_END = "."
+
+# HTK time units per second
+HTK_UNITS = 10000000
+
+# digits to which times in TextGrids are rounded
+PRECISION = 5
+
+# utterances in flight, per thread, when writing TextGrids in parallel
+BACKLOG = 4
+
+
+def read_mlf(filename):
+    """
+    Iterate over the label files in an MLF, yielding (name, lines) pairs
+    one label file at a time
+    """
+    with open(filename, "r") as source:
+        source.readline()  # header
+        name = None
+        for line in source:
+            line = line.rstrip()
+            if name is None:
+                m = match(MLF_NAME, line)
+                if m:
+                    name = m.group(1)
+                    lines = []
+            elif line == MLF_END:
+                yield (name, lines)
+                name = None
+            else:
+                lines.append(line)
+
+
+def print_block(name, lines, sink):
+    """
+    Print a single label file (without the MLF header) to `sink`
+    """
+    print('"{}"'.format(name), file=sink)
+    for line in lines:
+        print(line, file=sink)
+    print(MLF_END, file=sink)
+
+
+def write_mlf(filename, blocks):
+    """
+    Write an iterable of (name, lines) pairs to an MLF
+    """
+    with open(filename, "w") as sink:
+        print(MLF_HEADER, file=sink)
+        for (name, lines) in blocks:
+            print_block(name, lines, sink)
+
+
+def cat_mlf(filename, sources):
+    """
+    Concatenate MLFs in order, keeping only a single header
+    """
+    with open(filename, "w") as sink:
+        print(MLF_HEADER, file=sink)
+        for source in sources:
+            with open(source, "r") as handle:
+                handle.readline()  # header
+                copyfileobj(handle, sink)
+
+
+def to_textgrid(name, lines, samplerate=HTK_UNITS):
+    """
+    Convert a single label file, as output by HVite -o SM, into a TextGrid
+    with "phones" and "words" tiers (just as `textgrid.MLF` does)
+    """
+    grid = TextGrid(name)
+    phon = IntervalTier(name="phones")
+    word = IntervalTier(name="words")
+    wmrk = ""
+    wsrt = 0.
+    wend = 0.
+    for line in lines:
+        fields = line.split()
+        pmin = round(float(fields[0]) / samplerate, PRECISION)
+        pmax = round(float(fields[1]) / samplerate, PRECISION)
+        if len(fields) == 4:  # phone which begins a word
+            if pmin == pmax:
+                raise ValueError("Null duration interval in '{}'.".format(
+                                 name))
+            phon.add(pmin, pmax, fields[2])
+            if wmrk:
+                word.add(wsrt, wend, wmrk)
+            (wmrk, wsrt, wend) = (fields[3], pmin, pmax)
+        elif len(fields) == 3:  # just a phone
+            if fields[2] == "sp" and pmin != pmax:
+                if wmrk:
+                    word.add(wsrt, wend, wmrk)
+                (wmrk, wsrt, wend) = (fields[2], pmin, pmax)
+            elif pmin != pmax:
+                phon.add(pmin, pmax, fields[2])
+            wend = pmax
+    word.add(wsrt, wend, wmrk)
+    grid.append(phon)
+    grid.append(word)
+    return grid
+
+
+def textgrid_name(name, dirname):
+    """
+    Name of the TextGrid in `dirname` for the label file `name`
+    """
+    (_, filename) = os.path.split(name)
+    (basename, _) = os.path.splitext(filename)
+    return os.path.join(dirname, basename + ".TextGrid")
+
+
+def write_textgrid(name, lines, filename):
+    """
+    Write the TextGrid for a single label file to `filename`
+    """
+    with metrics.stage("textgrids", items=1):
+        to_textgrid(name, lines).write(filename)
+
+
+def write_textgrids(filename, dirname, jobs=1):
+    """
+    Write a TextGrid into `dirname` for each label file in the MLF
+    `filename`, returning the number written. Label files are read one at
+    a time and each TextGrid is written as soon as its label file has
+    been read, so memory use does not grow with the size of the MLF; if
+    `jobs` > 1, they are written by a pool of threads, with a bounded
+    number of label files in flight.
+    """
+    size = 0
+    if jobs == 1:
+        for (name, lines) in read_mlf(filename):
+            write_textgrid(name, lines, textgrid_name(name, dirname))
+            size += 1
+        return size
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = deque()
+        for (name, lines) in read_mlf(filename):
+            if len(futures) >= jobs * BACKLOG:
+                futures.popleft().result()
+            futures.append(executor.submit(write_textgrid, name, lines,
+                                           textgrid_name(name, dirname)))
+            size += 1
+        for future in futures:
+            future.result()
+    return size
@@ -24,17 +24,156 @@ Pronunciation dictionary utilities
 """
 
 
+import os
+import mmap
+import struct
 import logging
 
+from hashlib import sha1
 from collections import defaultdict
 
-from .utilities import SIL, SP
+from .utilities import SIL, SP, atomic_write, mkdir_p, user_cachedir
+
+
+# compiled dictionaries are kept in a cache directory, named for the
+# (absolute) path of the source dictionary and the phoneset
+COMPILED = ".idx"
+# header: magic, source mtime (ns), source size, phoneset digest, # words
+MAGIC = b"PLADICT1"
+HEADER = struct.Struct("=8sQQ20s4xQ")  # padded so offsets are aligned
+# offsets are machine-native, as compiled dictionaries are not portable
+OFFSET = struct.Struct("Q")
+
+
+def _phoneset_digest(phoneset):
+    return sha1(" ".join(sorted(phoneset)).encode("UTF-8")).digest()
+
+
+class CompiledDict(object):
+
+    """
+    A read-only, memory-mapped pronunciation dictionary, compiled from a
+    CMU-style dictionary into records sorted by word and an index of
+    their offsets, so that lookup is by binary search and only touches
+    the pages it needs
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as source:
+            self.mm = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.mtime, self.size, self.digest, self.count) = \
+            HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError("'{}' is not a compiled dictionary.".format(
+                             filename))
+        self.start = HEADER.size + OFFSET.size * self.count
+        self.offsets = memoryview(self.mm)[HEADER.size:self.start].cast(
+                                                             OFFSET.format)
+
+    @staticmethod
+    def compiled_name(filename, phoneset, cachedir):
+        """
+        Name of the compiled version of the dictionary `filename`, for
+        `phoneset`, in `cachedir`
+        """
+        key = sha1(os.path.abspath(filename).encode("UTF-8"))
+        key.update(_phoneset_digest(phoneset))
+        return os.path.join(cachedir, key.hexdigest() + COMPILED)
+
+    @classmethod
+    def load(cls, filename, phoneset, cachedir):
+        """
+        Open the compiled version of the dictionary `filename` in
+        `cachedir`, (re)building it if it is missing or out of date
+        """
+        compiled = cls.compiled_name(filename, phoneset, cachedir)
+        stat = os.stat(filename)
+        digest = _phoneset_digest(phoneset)
+        try:
+            compiled_dict = cls(compiled)
+            if (compiled_dict.mtime, compiled_dict.size,
+                    compiled_dict.digest) == (stat.st_mtime_ns, stat.st_size,
+                                              digest):
+                return compiled_dict
+            compiled_dict.close()
+        except (OSError, ValueError, struct.error):
+            pass
+        logging.debug("Compiling dictionary '{}'.".format(filename))
+        cls.compile(filename, compiled, phoneset, stat)
+        return cls(compiled)
+
+    @staticmethod
+    def compile(filename, compiled, phoneset, stat):
+        """
+        Validate the dictionary `filename` against `phoneset` and write
+        the compiled version to `compiled`
+        """
+        d = defaultdict(list)
+        with open(filename, "r") as source:
+            for (i, word, pron) in PronDict.pronify(source):
+                for ph in pron:
+                    if ph not in phoneset:
+                        logging.error("Unknown phone '{}' in dictionary '{}' (ln. {}).".format(ph, filename, i))
+                        exit(1)
+                d[word].append(" ".join(pron))
+        records = sorted("\t".join([word] + prons).encode("UTF-8") + b"\n"
+                         for (word, prons) in d.items())
+        (head, _) = os.path.split(os.path.abspath(compiled))
+        mkdir_p(head)
+        with atomic_write(compiled, "wb") as sink:
+            sink.write(HEADER.pack(MAGIC, stat.st_mtime_ns, stat.st_size,
+                                   _phoneset_digest(phoneset),
+                                   len(records)))
+            offset = 0
+            for record in records:
+                sink.write(OFFSET.pack(offset))
+                offset += len(record)
+            for record in records:
+                sink.write(record)
+
+    def _word(self, i):
+        start = self.start + self.offsets[i]
+        return self.mm[start:self.mm.find(b"\t", start)]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        """
+        Return the list of pronunciations for `key`, which is empty if
+        `key` is not in the dictionary
+        """
+        target = key.encode("UTF-8")
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._word(lo) != target:
+            return []
+        start = self.start + self.offsets[lo]
+        record = self.mm[start:self.mm.find(b"\n", start)].decode("UTF-8")
+        return [pron.split() for pron in record.split("\t")[1:]]
+
+    def __repr__(self):
+        return "{}(filename={!r})".format(self.__class__.__name__,
+                                          self.filename)
+
+    def close(self):
+        self.offsets.release()
+        self.mm.close()
 
 
 class PronDict(object):
 
     """
-    A wrapper for a normal pronunciation dictionary in the CMU style
+    A wrapper for a normal pronunciation dictionary in the CMU style;
+    dictionaries are compiled (see `CompiledDict`) and kept in `cachedir`
+    (by default, the user's cache directory), or, if that is not possible,
+    read into memory
     """
 
     SILENT_PHONES = frozenset([SIL, SP])
@@ -53,28 +192,46 @@ class PronDict(object):
             yield (i, word, pron.split())
 
     def add(self, filename):
+        phoneset = self.ps | self.SILENT_PHONES
+        # use the compiled dictionary if possible
+        try:
+            self.sources.append(CompiledDict.load(filename, phoneset,
+                                                  self.cachedir))
+            return
+        except OSError as err:
+            logging.debug("Cannot compile dictionary '{}': {}.".format(
+                          filename, err))
         # build up dictionary
         with open(filename, "r") as source:
             for (i, word, pron) in PronDict.pronify(source):
                 for ph in pron:
-                    if ph not in self.ps | self.SILENT_PHONES:
+                    if ph not in phoneset:
                         logging.error("Unknown phone '{}' in dictionary '{}' (ln. {}).".format(ph, filename, i))
                         exit(1)
                 self.d[word].append(pron)
 
-    def __init__(self, phoneset, filename=None):
+    def __init__(self, phoneset, filename=None, cachedir=None):
         self.ps = phoneset
+        self.cachedir = cachedir or user_cachedir()
+        self.sources = []
         self.d = defaultdict(list)
         if filename:
             self.add(filename)
         # for later...
         self.oov = set()
 
+    def _lookup(self, key):
+        prons = []
+        for source in self.sources:
+            prons.extend(source[key])
+        prons.extend(self.d.get(key, []))
+        return prons
+
     def __contains__(self, key):
-        return key in self.d and self.d[key] != []
+        return self._lookup(key) != []
 
     def __getitem__(self, key):
-        getlist = self.d[key]
+        getlist = self._lookup(key)
         if getlist:
             return getlist
         else:
@@ -82,7 +239,7 @@ class PronDict(object):
             raise KeyError(key)
 
     def __repr__(self):
-        return "PronDict({})".format(self.d)
+        return "PronDict(sources={!r}, {})".format(self.sources, self.d)
 
     def __setitem__(self, key, value):
         self.d[key].append(value)
@@ -0,0 +1,196 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Running the HTK tools
+
+Every HTK command is run through a `Runner`, which limits how many run at
+once, enforces a timeout, retries failed commands if asked to, and
+reports what a command wrote to standard error. Each `Aligner` and
+`Corpus` is given the runner to use (by default, one configured by its
+options), so that models with different settings do not interfere.
+"""
+
+import time
+import shlex
+import logging
+import subprocess
+
+from threading import BoundedSemaphore, Event, Timer
+from tempfile import TemporaryFile
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+
+# lines of standard error reported when a command fails
+STDERR_LINES = 20
+# seconds before retrying a failed command, doubled for each further retry
+BACKOFF = 1.
+
+
+class Runner(object):
+
+    """
+    Class representing a pool of (at most `jobs`, if given) HTK processes,
+    each of which is killed after `timeout` seconds (if given) and, by
+    `run`, retried up to `retries` times if it fails; if `trace` is True,
+    command lines are logged as they are run
+    """
+
+    def __init__(self, jobs=None, timeout=None, retries=0, trace=False):
+        self.jobs = jobs
+        self.slots = BoundedSemaphore(jobs) if jobs else nullcontext()
+        self.timeout = timeout
+        self.retries = retries
+        self.trace = trace
+
+    @classmethod
+    def from_opts(cls, opts):
+        """
+        Construct a runner configured by the (resolved) options `opts`
+        """
+        return cls(opts.get("jobs"), opts.get("timeout"),
+                   opts.get("retries") or 0, opts.get("trace") or False)
+
+    def __repr__(self):
+        return "{}(jobs={!r}, timeout={!r}, retries={!r})".format(
+               self.__class__.__name__, self.jobs, self.timeout,
+               self.retries)
+
+    def __reduce__(self):
+        # semaphores cannot be pickled (e.g., to pass to a worker process),
+        # but a new one will do
+        return (self.__class__, (self.jobs, self.timeout, self.retries,
+                                 self.trace))
+
+    def _trace(self, args):
+        if self.trace:
+            logging.info("Running: {}".format(shlex.join(args)))
+
+    def _warn(self, args, stderr):
+        """
+        Log what a successful command wrote to standard error (e.g., HTK's
+        warnings about utterances it could not align)
+        """
+        for line in stderr.decode("UTF-8", "replace").splitlines():
+            if line.strip():
+                logging.warning("{}: {}".format(args[0], line))
+
+    def _report(self, args, err):
+        """
+        Log the failure of a command, with the end of its standard error
+        """
+        if isinstance(err, subprocess.TimeoutExpired):
+            logging.error("'{}' timed out after {} s.".format(args[0],
+                                                              err.timeout))
+        else:
+            logging.error("'{}' failed with exit status {}.".format(
+                          args[0], err.returncode))
+        logging.error("Command line: {}".format(shlex.join(args)))
+        stderr = (err.stderr or b"").decode("UTF-8", "replace").splitlines()
+        for line in stderr[-STDERR_LINES:]:
+            logging.error("  {}".format(line))
+
+    def run(self, args, capture=False):
+        """
+        Run a command, returning its standard output if `capture` is True,
+        and raising `subprocess.CalledProcessError` (or `TimeoutExpired`)
+        if it still fails after any retries
+        """
+        attempt = 0
+        while True:
+            self._trace(args)
+            try:
+                with self.slots:
+                    proc = subprocess.run(args, stdout=subprocess.PIPE if
+                                          capture else None,
+                                          stderr=subprocess.PIPE,
+                                          timeout=self.timeout)
+                if proc.returncode == 0:
+                    self._warn(args, proc.stderr)
+                    return proc.stdout
+                err = subprocess.CalledProcessError(proc.returncode, args,
+                                                    proc.stdout, proc.stderr)
+            except subprocess.TimeoutExpired as timeout:
+                err = timeout
+            self._report(args, err)
+            if attempt >= self.retries:
+                raise err
+            attempt += 1
+            logging.warning("Retrying '{}' ({} of {}).".format(args[0],
+                            attempt, self.retries))
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+
+    def run_all(self, commands, capture=False):
+        """
+        Run a list of commands concurrently (subject to `self.jobs`),
+        returning a list of their results (see `run`)
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.run, args, capture) for args in
+                       commands]
+            return [future.result() for future in futures]
+
+    @contextmanager
+    def stream(self, args):
+        """
+        Start a command, yielding the process so that its standard output
+        can be read as it is written, and then wait for it to finish,
+        raising `subprocess.CalledProcessError` if it fails; as its output
+        may already have been used, it is not retried
+        """
+        self._trace(args)
+        with self.slots, TemporaryFile() as stderr:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    stderr=stderr)
+            expired = Event()
+            timer = None
+            if self.timeout:
+
+                def expire():
+                    expired.set()
+                    proc.kill()
+
+                timer = Timer(self.timeout, expire)
+                timer.start()
+            try:
+                yield proc
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+                if timer:
+                    timer.cancel()
+            stderr.seek(0)
+            if returncode == 0:
+                self._warn(args, stderr.read())
+                return
+            if expired.is_set():
+                err = subprocess.TimeoutExpired(args, self.timeout,
+                                                stderr=stderr.read())
+            else:
+                err = subprocess.CalledProcessError(returncode, args,
+                                                    stderr=stderr.read())
+            self._report(args, err)
+            raise err
+
@@ -0,0 +1,210 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Alignment server, which keeps an aligner loaded between requests
+
+Requests are POSTed to /align as a JSON object of the form
+
+    {"utterances": [{"name": ..., "wav_data": ..., "text": ...}, ...]}
+
+where "wav_data" is the base64-encoded audio, and "text" the transcript.
+If the server was given a root directory, "wav" and "lab" may instead be
+paths to the audio and transcript, relative to (and within) that root.
+The response is a JSON object with the aligned "mlf", and the "textgrids"
+and "scores" for each utterance, keyed by name.
+"""
+
+import os
+import json
+import logging
+
+from base64 import b64decode
+from binascii import Error as DecodeError
+from csv import reader
+from glob import glob
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .corpus import Corpus
+from .mlf import write_textgrids
+from .utilities import splitname, ALIGNED, SCORES
+
+
+class RequestError(Exception):
+    pass
+
+
+class AlignerRequestHandler(BaseHTTPRequestHandler):
+
+    """
+    Handler for alignment requests
+    """
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt, *args)
+
+    def _reply(self, code, response):
+        body = json.dumps(response).encode("UTF-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._reply(404, {"error": "Not found."})
+            return
+        self._reply(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/align":
+            self._reply(404, {"error": "Not found."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("UTF-8"))
+            self._reply(200, self.server.align(request["utterances"]))
+        except (ValueError, KeyError, TypeError) as err:
+            self._reply(400, {"error": "Malformed request: {}.".format(err)})
+        except RequestError as err:
+            self._reply(400, {"error": str(err)})
+        except Exception as err:
+            logging.exception("Alignment failed.")
+            self._reply(500, {"error": str(err)})
+
+
+class AlignerServer(HTTPServer):
+
+    """
+    Class representing an HTTP server which aligns the utterances it is
+    sent using a `Model` loaded once, at startup; as the aligner's working
+    files are shared, requests are handled one at a time. Utterances may
+    name files only under `root`, if it is given
+    """
+
+    def __init__(self, address, model, root=None):
+        super(AlignerServer, self).__init__(address, AlignerRequestHandler)
+        self.model = model
+        self.root = os.path.realpath(root) if root else None
+        # read the dictionaries now, rather than on the first request
+        self.model.thedict
+
+    def _path(self, path):
+        """
+        Resolve a path named in a request, which must lie under the root
+        """
+        if self.root is None:
+            raise RequestError("Paths are not accepted by this server.")
+        resolved = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, resolved]) != self.root:
+            raise RequestError("Path '{}' is outside the root.".format(path))
+        return resolved
+
+    def _stage(self, dirname, utterances):
+        """
+        Copy (or decode) the requested utterances into `dirname`, and
+        return the set of words sent inline
+        """
+        words = set()
+        for utterance in utterances:
+            name = utterance["name"]
+            if not name or os.path.basename(name) != name:
+                raise RequestError("Bad utterance name '{}'.".format(name))
+            # hidden files are not part of a corpus (see `corpus._walk`)
+            if name.startswith("."):
+                raise RequestError("Utterance name '{}' begins with "
+                                   "'.'.".format(name))
+            wavfile = os.path.join(dirname, name + ".wav")
+            labfile = os.path.join(dirname, name + ".lab")
+            if os.path.exists(wavfile):
+                raise RequestError("Duplicate utterance '{}'.".format(name))
+            if "wav_data" in utterance:
+                try:
+                    data = b64decode(utterance["wav_data"], validate=True)
+                except DecodeError:
+                    raise RequestError("Bad audio data for '{}'.".format(
+                                       name))
+                with open(wavfile, "wb") as sink:
+                    sink.write(data)
+            else:
+                copyfile(self._path(utterance["wav"]), wavfile)
+            if "text" in utterance:
+                with open(labfile, "w") as sink:
+                    print(utterance["text"], file=sink)
+                words.update(utterance["text"].split())
+            else:
+                copyfile(self._path(utterance["lab"]), labfile)
+        return words
+
+    def align(self, utterances):
+        """
+        Align a list of utterances, returning the response
+        """
+        if not utterances:
+            raise RequestError("No utterances.")
+        tmpdir = mkdtemp(dir=os.environ.get("TMPDIR", None))
+        try:
+            # utterances are staged apart from the reports on them
+            datadir = os.path.join(tmpdir, "data")
+            os.mkdir(datadir)
+            try:
+                words = self._stage(datadir, utterances)
+            except OSError as err:
+                raise RequestError("Cannot read data: {}.".format(
+                                   err.strerror))
+            # errors in the data are reported by exiting
+            try:
+                corpus = Corpus(datadir, self.model.opts,
+                                self.model.thedict, reportdir=tmpdir,
+                                runner=self.model.aligner.runner)
+            except SystemExit:
+                oov = self.model.thedict.oov
+                if oov:
+                    # only words sent inline are echoed back
+                    shown = sorted(oov & words)
+                    hidden = len(oov) - len(shown)
+                    raise RequestError("OOV word(s){}{}.".format(
+                        ": " + " ".join(shown) if shown else "",
+                        " ({} in transcripts read from files)".format(
+                        hidden) if hidden else ""))
+                raise RequestError("Cannot prepare data.")
+            aligned = os.path.join(tmpdir, ALIGNED)
+            scores = os.path.join(tmpdir, SCORES)
+            self.model.aligner.align_and_score(corpus, aligned, scores)
+            del corpus
+            response = {"textgrids": {}, "scores": {}}
+            with open(aligned, "r") as source:
+                response["mlf"] = source.read()
+            with open(scores, "r") as source:
+                for (audiofile, score) in reader(source):
+                    response["scores"][splitname(audiofile)[1]] = \
+                        float(score)
+            write_textgrids(aligned, datadir)
+            for textgrid in glob(os.path.join(datadir, "*.TextGrid")):
+                with open(textgrid, "r", encoding="UTF-8") as source:
+                    response["textgrids"][splitname(textgrid)[1]] = \
+                        source.read()
+            return response
+        finally:
+            rmtree(tmpdir)
@@ -0,0 +1,136 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tables of aligned intervals, for bulk analysis
+"""
+
+import os
+import csv
+import json
+import logging
+
+from threading import Lock
+
+from .mlf import to_textgrid
+
+
+# table formats, by extension
+CSV = ".csv"
+JSONL = ".jsonl"
+PARQUET = ".parquet"
+FORMATS = (CSV, JSONL, PARQUET)
+
+COLUMNS = ("file", "tier", "start", "end", "label", "score")
+
+# rows per Parquet row group
+ROW_GROUP = 1 << 16
+
+
+class Table(object):
+
+    """
+    Class representing a table of aligned intervals, one row per phone or
+    word (as in the TextGrids), together with the score for the file, in
+    CSV, JSON lines, or (if pyarrow is available) Parquet format, chosen
+    by extension; rows are written as each file is added, so the table
+    need never be held in memory, and files may be added concurrently
+    """
+
+    def __init__(self, filename):
+        (_, ext) = os.path.splitext(filename)
+        ext = ext.lower()
+        if ext not in FORMATS:
+            logging.error("Unknown table format '{}' (not one of {}).".format(
+                          ext, ", ".join(FORMATS)))
+            exit(1)
+        self.filename = filename
+        self.format = ext
+        self.lock = Lock()
+        self.rows = []
+        if self.format == PARQUET:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                logging.error("Parquet tables require pyarrow.")
+                exit(1)
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([("file", pyarrow.string()),
+                                          ("tier", pyarrow.string()),
+                                          ("start", pyarrow.float64()),
+                                          ("end", pyarrow.float64()),
+                                          ("label", pyarrow.string()),
+                                          ("score", pyarrow.float64())])
+            self.writer = pyarrow.parquet.ParquetWriter(filename,
+                                                        self.schema)
+            return
+        self.sink = open(filename, "w", encoding="UTF-8", newline="")
+        if self.format == CSV:
+            self.writer = csv.writer(self.sink)
+            self.writer.writerow(COLUMNS)
+
+    def __repr__(self):
+        return "{}(filename={!r})".format(self.__class__.__name__,
+                                          self.filename)
+
+    def add(self, audiofile, name, lines, score):
+        """
+        Add the intervals in a single label file, as output by HVite
+        """
+        score = None if score is None else float(score)
+        rows = []
+        for tier in to_textgrid(name, lines):
+            for interval in tier:
+                rows.append((audiofile, tier.name, interval.minTime,
+                             interval.maxTime, interval.mark, score))
+        with self.lock:
+            if self.format == PARQUET:
+                self.rows.extend(rows)
+                if len(self.rows) >= ROW_GROUP:
+                    self._flush()
+            elif self.format == CSV:
+                self.writer.writerows(rows)
+            else:
+                for row in rows:
+                    print(json.dumps(dict(zip(COLUMNS, row))),
+                          file=self.sink)
+
+    def _flush(self):
+        """
+        Write buffered rows to the Parquet file as a row group
+        """
+        columns = list(zip(*self.rows)) if self.rows else \
+                  [() for _ in COLUMNS]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+                                [self.pyarrow.array(column, type=field.type)
+                                 for (column, field) in
+                                 zip(columns, self.schema)],
+                                schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if self.format == PARQUET:
+            if self.rows:
+                self._flush()
+            self.writer.close()
+        else:
+            self.sink.close()
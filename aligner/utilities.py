@@ -7,6 +7,9 @@ import logging
 import os
 import yaml
 
+from contextlib import contextmanager
+from tempfile import mkstemp
+
 # global variables
 
 SP = "sp"
@@ -14,10 +17,21 @@ SIL = "sil"
 TEMP = "temp"
 
 EPOCHS = 5
+MIN_EPOCHS = 1
+JOBS = 1
+RETRIES = 0
+
+RESAMPLER = "poly"
+
+MB = 1 << 20
+FEATURE_CACHE_SIZE = 10240  # in MB
 
 MISSING = "missing.txt"
 OOV = "OOV.txt"
 
+DICTIONARY = "eng.dict"
+MODEL = "eng.zip"
+
 CONFIG = "config.yaml"
 DICT = "dict"
 HMMDEFS = "hmmdefs"
@@ -25,8 +39,19 @@ MACROS = "macros"
 PROTO = "proto"
 VFLOORS = "vFloors"
 
+MANIFEST = "manifest.json"
+
 ALIGNED = ".aligned.mlf"
 SCORES = ".scores.csv"
+FINGERPRINTS = ".fingerprints.json"
+METRICS = ".metrics.json"
+
+
+# options which only make sense on this machine (or for this run), and so
+# are neither saved with models nor used to fingerprint training inputs
+RUNTIME_OPTIONS = ("jobs", "shards", "feature_cache", "feature_cache_size",
+                   "resampler", "channel", "workdir", "resume", "timeout",
+                   "retries", "trace")
 
 
 # samplerates which appear to be HTK-compatible (all divisors of 1e7)
@@ -54,6 +79,39 @@ def mkdir_p(dirname):
     os.makedirs(dirname, exist_ok=True)
 
 
+@contextmanager
+def atomic_write(filename, mode="w"):
+    """
+    Open a temporary file beside `filename` for writing, and move it into
+    place once written, so that other processes (e.g., concurrent runs
+    sharing a cache) never see a partial file; if writing fails, the
+    temporary file is removed and `filename` is left as it was
+    """
+    (dirname, _) = os.path.split(os.path.abspath(filename))
+    (fd, temp) = mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, mode) as sink:
+            yield sink
+            sink.flush()
+            os.fsync(sink.fileno())
+        # mkstemp creates files readable only by their owner
+        os.chmod(temp, 0o644)
+        os.replace(temp, filename)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def user_cachedir():
+    """
+    Directory in which to cache files (e.g., compiled dictionaries) for
+    this user, following the XDG convention
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+           os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "prosodylab-aligner")
+
+
 def splitname(fullname):
     """
     Split a filename into directory, basename, and extension
@@ -81,6 +139,30 @@ def resolve_opts(args):
     if not args.epochs:
         args.epochs = EPOCHS
     opts["epochs"] = args.epochs
+    # could be either, and the command line takes precedent; by default,
+    # there is no early stopping
+    if args.convergence_threshold is not None:
+        opts["convergence_threshold"] = args.convergence_threshold
+    elif "convergence_threshold" not in opts:
+        opts["convergence_threshold"] = None
+    if args.min_epochs:
+        opts["min_epochs"] = args.min_epochs
+    elif "min_epochs" not in opts:
+        opts["min_epochs"] = MIN_EPOCHS
+    # could be either, and the command line takes precedent.
+    opts["jobs"] = args.jobs if args.jobs else opts.get("jobs", JOBS)
+    # by default, one shard per job
+    if args.shards:
+        opts["shards"] = args.shards
+    elif "shards" not in opts:
+        opts["shards"] = opts["jobs"]
+    # likewise
+    opts["feature_cache"] = args.feature_cache if args.feature_cache \
+                            else opts.get("feature_cache", None)
+    if args.feature_cache_size is not None:
+        opts["feature_cache_size"] = args.feature_cache_size
+    elif "feature_cache_size" not in opts:
+        opts["feature_cache_size"] = FEATURE_CACHE_SIZE
     # could be either, and the command line takes precedent.
     try:
         sr = args.samplerate if args.samplerate else opts["samplerate"]
@@ -99,4 +181,30 @@ def resolve_opts(args):
         sr = SAMPLERATES[i]
         logging.warning("Using {} Hz as samplerate".format(sr))
     opts["samplerate"] = sr
+    if args.resampler:
+        opts["resampler"] = args.resampler
+    elif "resampler" not in opts:
+        opts["resampler"] = RESAMPLER
+    # command line only
+    opts["workdir"] = args.workdir
+    opts["resume"] = args.resume
+    if args.resume and not args.workdir:
+        logging.error("Cannot resume without a work directory (--workdir).")
+        exit(1)
+    # None means all channels are mixed down
+    if args.channel is not None:
+        opts["channel"] = args.channel
+    elif "channel" not in opts:
+        opts["channel"] = None
+    # likewise; no timeout by default
+    if args.timeout is not None:
+        opts["timeout"] = args.timeout
+    elif "timeout" not in opts:
+        opts["timeout"] = None
+    if args.retries is not None:
+        opts["retries"] = args.retries
+    elif "retries" not in opts:
+        opts["retries"] = RETRIES
+    # command line only
+    opts["trace"] = args.trace
     return opts
@@ -23,11 +23,85 @@
 Utilities for audio resampling (etc.)
 """
 
+import os
 import wave
+import struct
 
-from numpy import asarray
+from math import gcd
+from collections import namedtuple
+from numpy import asarray, clip, concatenate, dtype, empty, float64, \
+                  iinfo, int32, int8, integer, issubdtype, memmap, rint
 from scipy.io import wavfile
-from scipy.signal import resample
+from scipy.signal import resample, resample_poly
+
+
+# resampling methods
+FFT = "fft"
+POLY = "poly"
+RESAMPLERS = (POLY, FFT)
+
+# # of input samples resampled at a time when streaming
+BLOCKSIZE = 1 << 16
+
+# wav formats
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# numpy types for samples, by format and sample width; 24-bit samples are
+# mapped as triples of bytes
+SAMPLE_TYPES = {(WAVE_FORMAT_PCM, 1): dtype("u1"),
+                (WAVE_FORMAT_PCM, 2): dtype("<i2"),
+                (WAVE_FORMAT_PCM, 3): dtype("u1"),
+                (WAVE_FORMAT_PCM, 4): dtype("<i4"),
+                (WAVE_FORMAT_IEEE_FLOAT, 4): dtype("<f4"),
+                (WAVE_FORMAT_IEEE_FLOAT, 8): dtype("<f8")}
+
+# what HTK can read
+HTK_SAMPWIDTH = 2
+HTK_SCALE = 1 << 15
+
+
+WavInfo = namedtuple("WavInfo", ["samplerate", "channels", "sampwidth",
+                                 "nframes", "format", "offset"])
+
+
+def _cast(signal, sample_type):
+    """
+    Round and clip a signal to fit an integer sample type
+    """
+    if issubdtype(sample_type, integer):
+        info = iinfo(sample_type)
+        signal = clip(rint(signal), info.min, info.max)
+    return signal.astype(sample_type)
+
+
+def _decode(samples, info):
+    """
+    Convert raw samples (as mapped by `WavFile.samples`) to floating
+    point, with a full scale of [-1, 1)
+    """
+    if info.format == WAVE_FORMAT_IEEE_FLOAT:
+        return samples.astype(float64)
+    if info.sampwidth == 1:
+        return (samples.astype(float64) - 128) / 128
+    if info.sampwidth == 3:
+        samples = samples[..., 0].astype(int32) | \
+                  samples[..., 1].astype(int32) << 8 | \
+                  samples[..., 2].view(int8).astype(int32) << 16
+    return samples.astype(float64) / (1 << (8 * info.sampwidth - 1))
+
+
+def _mono(samples, info, channel):
+    """
+    Select `channel` from a block of raw samples, or mix all channels down
+    if `channel` is None, returning floating point samples
+    """
+    if info.channels == 1:
+        return _decode(samples[:, 0], info)
+    if channel is None:
+        return _decode(samples, info).mean(axis=1)
+    return _decode(samples[:, channel], info)
 
 
 class WavFile(object):
@@ -40,23 +114,191 @@ class WavFile(object):
         self.signal = asarray(signal)
         self.Fs = Fs
 
+    @staticmethod
+    def info(filename):
+        """
+        Get samplerate, # of channels, sample width (in bytes), # of
+        frames, format, and the offset of the sample data by reading the
+        header, without touching the samples themselves
+        """
+        with open(filename, "rb") as source:
+            header = source.read(12)
+            if len(header) < 12 or header[:4] != b"RIFF" or \
+                    header[8:] != b"WAVE":
+                raise ValueError("'{}' is not a wav file.".format(filename))
+            fmt = None
+            while True:
+                header = source.read(8)
+                if len(header) < 8:
+                    raise ValueError("'{}' has no data.".format(filename))
+                (chunk, size) = struct.unpack("<4sI", header)
+                if chunk == b"fmt ":
+                    body = source.read(size + (size & 1))
+                    fmt = struct.unpack_from("<HHIIHH", body)
+                    if fmt[0] == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                        # the real format is the start of the subformat
+                        (subformat,) = struct.unpack_from("<H", body, 24)
+                        fmt = (subformat,) + fmt[1:]
+                elif chunk == b"data":
+                    if fmt is None:
+                        raise ValueError("'{}' has no format.".format(
+                                         filename))
+                    (tag, channels, samplerate, _, _, bits) = fmt
+                    sampwidth = (bits + 7) // 8
+                    offset = source.tell()
+                    # the size is unreliable in files written as streams
+                    size = min(size,
+                               os.fstat(source.fileno()).st_size - offset)
+                    return WavInfo(samplerate, channels, sampwidth,
+                                   size // (sampwidth * channels), tag,
+                                   offset)
+                else:  # chunks are padded to an even length
+                    source.seek(size + (size & 1), os.SEEK_CUR)
+
+    @staticmethod
+    def samples(filename, info=None):
+        """
+        Memory-map the samples of a wav file, without reading them,
+        returning an array of shape (# of frames, # of channels), or (# of
+        frames, # of channels, 3) for 24-bit audio
+        """
+        if info is None:
+            info = WavFile.info(filename)
+        key = (info.format, info.sampwidth)
+        if key not in SAMPLE_TYPES:
+            raise ValueError("Unsupported format in '{}'.".format(filename))
+        shape = (info.nframes, info.channels)
+        if info.sampwidth == 3:
+            shape += (3,)
+        return memmap(filename, dtype=SAMPLE_TYPES[key], mode="r",
+                      offset=info.offset, shape=shape)
+
     @staticmethod
     def samplerate(filename):
         """
         Get samplerate without reading the entire wav file into memory
         """
-        with wave.open(filename, "r") as source:
-            return source.getframerate()
+        return WavFile.info(filename).samplerate
+
+    @staticmethod
+    def duration(filename):
+        """
+        Get duration (in seconds) without reading the entire wav file into
+        memory
+        """
+        info = WavFile.info(filename)
+        return info.nframes / info.samplerate
+
+    @staticmethod
+    def read_mono(filename, start=0, stop=None, channel=None, info=None):
+        """
+        Read frames `start` through `stop` (exclusive) of a wav file as
+        floating point samples in [-1, 1), selecting `channel` from
+        multichannel audio or mixing all channels down if it is None
+        """
+        if info is None:
+            info = WavFile.info(filename)
+        samples = WavFile.samples(filename, info)
+        return _mono(samples[start:stop], info, channel)
+
+    @staticmethod
+    def write_mono(filename, signal, Fs):
+        """
+        Write floating point samples in [-1, 1) as mono 16-bit PCM
+        """
+        with wave.open(filename, "w") as sink:
+            sink.setnchannels(1)
+            sink.setsampwidth(HTK_SAMPWIDTH)
+            sink.setframerate(Fs)
+            sink.writeframes(_cast(signal * HTK_SCALE, "<i2").tobytes())
 
     @classmethod
-    def from_file(cls, filename):
-        (Fs, signal) = wavfile.read(filename)
+    def from_file(cls, filename, channel=None, mmap=False):
+        """
+        Read a wav file, selecting `channel` from multichannel audio or
+        mixing all channels down if `channel` is None; if `mmap` is True,
+        samples are memory-mapped rather than read and, unless they need to
+        be mixed down, not copied
+        """
+        if mmap:
+            info = WavFile.info(filename)
+            if info.sampwidth == 3:
+                raise ValueError("Cannot memory-map 24-bit audio" +
+                                 " in '{}'.".format(filename))
+            (Fs, signal) = (info.samplerate,
+                            WavFile.samples(filename, info))
+            if info.channels == 1:
+                signal = signal[:, 0]
+        else:
+            (Fs, signal) = wavfile.read(filename)
         if signal.ndim > 1:
-            raise ValueError("Expected mono audio," +
-                             " but '{}'".format(filename) +
-                             " has {} channels.".format(signal.ndim))
+            if channel is None:
+                signal = _cast(signal.mean(axis=1), signal.dtype)
+            else:
+                signal = signal[:, channel]
         return cls(signal, Fs)
 
+    @staticmethod
+    def resample_file(source, sink, Fs_out, channel=None, method=POLY,
+                      blocksize=BLOCKSIZE):
+        """
+        Convert the wav file `source` to mono 16-bit PCM at `Fs_out` Hz, as
+        HTK requires, and write the result to `sink`; `channel` is selected
+        from multichannel audio (and ignored for mono audio), or all
+        channels are mixed down if it is None.
+
+        With the polyphase method, the memory-mapped samples are read,
+        filtered, and written one block at a time so that memory use does
+        not grow with the length of the file. Each block is passed through
+        the filter together with enough of its neighbors to cover the
+        filter's support, so the result is the same as applying
+        `resample_poly` to the whole file.
+        """
+        info = WavFile.info(source)
+        samples = WavFile.samples(source, info)
+        if channel is not None and info.channels > 1 and \
+                not 0 <= channel < info.channels:
+            raise ValueError("No channel {} in '{}'.".format(channel, source))
+        with wave.open(sink, "w") as snk:
+            snk.setnchannels(1)
+            snk.setsampwidth(HTK_SAMPWIDTH)
+            snk.setframerate(Fs_out)
+            if method != POLY:
+                signal = _mono(samples, info, channel)
+                if Fs_out != info.samplerate:
+                    signal = resample(signal, int(Fs_out / info.samplerate *
+                                                  len(signal)))
+                snk.writeframes(_cast(signal * HTK_SCALE,
+                                      "<i2").tobytes())
+                return
+            g = gcd(info.samplerate, Fs_out)
+            (up, down) = (Fs_out // g, info.samplerate // g)
+            # input samples on either side of a block needed to cover the
+            # filter (which has a half-length of 10 * max(up, down) samples
+            # at the upsampled rate); rounding this, and the blocks, up to
+            # multiples of `down` makes them begin on output samples
+            context = -(-10 * max(up, down) // up) + 1
+            context = -(-context // down) * down
+            step = max(blocksize // down, 1) * down
+            n = info.nframes
+            buf = empty(0, dtype=float64)
+            offset = 0  # index of `buf[0]` in the whole signal
+            for start in range(0, n, step):
+                stop = min(start + step, n)
+                lo = max(start - context, 0)
+                hi = min(stop + context, n)
+                # discard samples no longer needed and decode new ones
+                buf = buf[lo - offset:]
+                offset = lo
+                if hi - offset > len(buf):
+                    block = samples[offset + len(buf):hi]
+                    buf = concatenate([buf, _mono(block, info, channel)])
+                resampled = resample_poly(buf[:hi - offset], up, down)
+                first = (start - lo) * up // down
+                last = -(-stop * up // down) - lo * up // down
+                snk.writeframes(_cast(resampled[first:last] * HTK_SCALE,
+                                      "<i2").tobytes())
+
     def __repr__(self):
         return "{}(signal={!r}, Fs={!r})".format(self.__class__.__name__,
                                                  self.signal, self.Fs)
@@ -67,14 +309,20 @@ class WavFile(object):
     def write(self, filename):
         wavfile.write(filename, self.Fs, self.signal)
 
-    def _resample(self, Fs_out):
-        ratio = Fs_out / self.Fs
-        resampled_signal = resample(self.signal, int(ratio * len(self)))
-        return resampled_signal
+    def _resample(self, Fs_out, method=FFT):
+        if method == POLY:
+            g = gcd(self.Fs, Fs_out)
+            resampled_signal = resample_poly(self.signal, Fs_out // g,
+                                             self.Fs // g)
+        else:
+            ratio = Fs_out / self.Fs
+            resampled_signal = resample(self.signal, int(ratio * len(self)))
+        # keep the original sample format, since HTK can't read floats
+        return _cast(resampled_signal, self.signal.dtype)
 
-    def resample(self, Fs_out):
-        return WavFile(self._resample(Fs_out), Fs_out)
+    def resample(self, Fs_out, method=FFT):
+        return WavFile(self._resample(Fs_out, method), Fs_out)
 
-    def resample_bang(self, Fs_out):
-        self.signal = self._resample(Fs_out)
+    def resample_bang(self, Fs_out, method=FFT):
+        self.signal = self._resample(Fs_out, method)
         self.Fs = Fs_out
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# fakehtk.py: stand-ins for the HTK tools, for benchmarking without HTK
+#
+# Invoked by the name of an HTK tool (e.g., through a symlink), this
+# reads and writes files of the same form as that tool would, with
+# plausible contents (e.g., each phone is given an equal share of the
+# frames), but does none of the actual work, so that the time spent in the
+# aligner itself can be measured.
+
+import os
+import re
+import struct
+import sys
+import shutil
+import wave
+
+
+def opts(argv, flags, multi=()):
+    """
+    Minimal HTK-style option parser: each of `flags` takes one argument,
+    and those in `multi` may be repeated; other flags take none
+    """
+    found = {}
+    rest = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith("-") and len(arg) == 2:
+            key = arg[1]
+            if key in flags:
+                value = argv[i + 1]
+                i += 2
+                if key in multi:
+                    found.setdefault(key, []).append(value)
+                else:
+                    found[key] = value
+                continue
+            found[key] = True
+            i += 1
+            continue
+        rest.append(arg)
+        i += 1
+    return (found, rest)
+
+
+def scp(filename):
+    with open(filename) as source:
+        for line in source:
+            yield [f.strip('"') for f in re.findall(r'"[^"]*"|\S+', line)]
+
+
+def read_mlf(filename):
+    blocks = {}
+    with open(filename) as source:
+        source.readline()
+        name = None
+        for line in source:
+            line = line.rstrip()
+            if name is None:
+                name = line.strip('"')
+                lines = []
+            elif line == ".":
+                blocks[os.path.splitext(os.path.basename(name))[0]] = lines
+                name = None
+            else:
+                lines.append(line)
+    return blocks
+
+
+def read_dict(filename):
+    d = {}
+    with open(filename) as source:
+        for line in source:
+            fields = line.split()
+            if fields:
+                d.setdefault(fields[0], []).append(fields[1:])
+    return d
+
+
+def HCopy(argv):
+    (o, _) = opts(argv, "CST")
+    for (src, dst) in scp(o["S"]):
+        with wave.open(src) as w:
+            frames = int(w.getnframes() / w.getframerate() * 100)
+        with open(dst, "wb") as sink:
+            sink.write(struct.pack(">iihh", frames, 100000, 39 * 4, 838))
+            sink.write(bytes(frames * 39 * 4))
+
+
+def HDMan(argv):
+    (o, rest) = opts(argv, "gwnT")
+    (taskdict, dicts) = (rest[0], rest[1:])
+    with open(o["w"]) as source:
+        words = set(source.read().split())
+    phones = set()
+    entries = []
+    for dic in dicts:
+        for (word, prons) in read_dict(dic).items():
+            if word in words:
+                for pron in prons:
+                    if (word, pron) not in entries:
+                        entries.append((word, pron))
+    with open(taskdict, "w") as sink:
+        for (word, pron) in sorted(entries):
+            phones.update(pron)
+            print(word, " ".join(pron + ["sp"]), file=sink)
+    phones.add("sp")
+    with open(o["n"], "w") as sink:
+        print("\n".join(sorted(phones)), file=sink)
+
+
+def HLEd(argv):
+    (o, rest) = opts(argv, "ldiT")
+    (script, source) = rest
+    with open(script) as handle:
+        delete_sp = "DE sp" in handle.read()
+    d = read_dict(o["d"])
+    with open(o["i"], "w") as sink:
+        print("#!MLF!#", file=sink)
+        for (name, words) in read_mlf(source).items():
+            print('"{}/{}.lab"'.format(o.get("l", "*"), name), file=sink)
+            phones = ["sil"]
+            for word in words:
+                word = word.split()[-1] if len(word.split()) > 2 else word
+                phones.extend(d[word][0])
+            if delete_sp:
+                phones = [p for p in phones if p != "sp"]
+            phones.append("sil")
+            print("\n".join(phones), file=sink)
+            print(".", file=sink)
+
+
+def HCompV(argv):
+    (o, rest) = opts(argv, "fCSMT")
+    proto = rest[0]
+    shutil.copy(proto, o["M"])
+    with open(os.path.join(o["M"], "vFloors"), "w") as sink:
+        print('~v varFloor1\n<Variance> 39\n' + " ".join(["0.01"] * 39),
+              file=sink)
+
+
+def _copy_model(hs, outdir):
+    for h in hs:
+        shutil.copy(h, os.path.join(outdir, os.path.basename(h)))
+
+
+def HERest(argv):
+    (o, rest) = opts(argv, "CSIMHtpT", multi="Ht")
+    # -t takes up to three arguments; ignore the rest of them
+    rest = [r for r in rest if not re.match(r"^\d+$", r)]
+    p = int(o.get("p", -1))
+    if p > 0:
+        with open(os.path.join(o["M"], "HER{}.acc".format(p)), "w") as sink:
+            print(o["S"], file=sink)
+    else:
+        _copy_model(o["H"], o["M"])
+    # as in HTK, only a full reestimation (or the merge of accumulators)
+    # reports the likelihood
+    if "T" in o and p <= 0:
+        base = os.path.basename(os.path.dirname(o["H"][0]))
+        n = int(base) if base.isdigit() else 0
+        value = -60 - 10 * 0.5 ** n
+        print("Reestimation complete - average log prob per frame = "
+              "{:e}".format(value))
+
+
+def HHEd(argv):
+    (o, rest) = opts(argv, "HMT", multi="H")
+    _copy_model(o["H"], o["M"])
+
+
+def HVite(argv):
+    (o, rest) = opts(argv, "TobiylLCSHIst", multi="H")
+    (taskdict, _) = rest[-2:]
+    d = read_dict(taskdict)
+    words = read_mlf(o["I"])
+    out = None
+    if "i" in o:
+        out = open(o["i"], "w")
+        print("#!MLF!#", file=out)
+    for (feature,) in scp(o["S"]):
+        name = os.path.splitext(os.path.basename(feature))[0]
+        with open(feature, "rb") as source:
+            (frames,) = struct.unpack(">i", source.read(4))
+        if "T" in o:
+            print("Aligning File: {}".format(feature))
+        phones = [("sil", "sil")]
+        for word in words[name]:
+            fields = word.split()
+            if len(fields) > 1:  # timed (realigned) labels
+                if len(fields) < 4 or fields[3] in ("sil", "sp"):
+                    continue
+                word = fields[3]
+            pron = [p for p in d[word][0] if p != "sp"]
+            phones.append((pron[0], word))
+            phones.extend((p, None) for p in pron[1:])
+        phones.append(("sil", "sil"))
+        step = max(frames // len(phones), 1)
+        lines = []
+        for (i, (phone, word)) in enumerate(phones):
+            start = i * step * 100000
+            end = (i + 1) * step * 100000 if i < len(phones) - 1 else \
+                max(frames, (i + 1) * step) * 100000
+            lines.append(" ".join(str(f) for f in (start, end, phone, word)
+                                  if f is not None))
+        if "T" in o:
+            print("{} ==  [{} frames] -65.4321 [Ac=-1.0 LM=0.0] (Act=1.0)"
+                  .format(feature, frames), flush=True)
+        if out:
+            print('"*/{}.lab"'.format(name), file=out)
+            print("\n".join(lines), file=out)
+            print(".", file=out)
+        if "l" in o:
+            with open(os.path.join(o["l"], name + ".lab"), "w") as sink:
+                print("\n".join(lines), file=sink)
+    if out:
+        out.close()
+
+
+if __name__ == "__main__":
+    globals()[os.path.basename(sys.argv[0])](sys.argv[1:])
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# run.py: end-to-end benchmark of the aligner, without HTK
+#
+# A synthetic corpus is generated (see synth.py) and aligned (and,
+# optionally, first trained on) with the HTK tools replaced by the
+# stand-ins in fakehtk.py, and the time spent in each stage of the aligner
+# and in each HTK tool, together with peak memory use, is written out as
+# JSON, so that runs before and after a change can be compared. With more
+# than one shard, features are extracted in worker processes, so the
+# resampling and HCopy within them are not broken out.
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import tracemalloc
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import aligner.api
+
+from aligner.api import Model
+from aligner.corpus import Corpus
+from aligner.aligner import Aligner
+from aligner.prondict import PronDict
+from aligner.runner import Runner
+from aligner.wavfile import WavFile
+
+from synth import make_corpus, MIN_DURATION, MAX_DURATION, SIZE
+
+
+TOOLS = ("HCompV", "HCopy", "HDMan", "HERest", "HHEd", "HLEd", "HVite")
+
+# functions timed (as `stage`: (owner, attribute)) wherever they are called
+FUNCTIONS = {"dictionary": (PronDict, "add"),
+             "corpus.lists": (Corpus, "_lists"),
+             "corpus.labels": (Corpus, "_prepare_label"),
+             "corpus.audio": (Corpus, "_prepare_audio"),
+             "corpus.features": (Corpus, "_extract_features"),
+             "resample": (WavFile, "resample_file"),
+             "train.flatstart": (Aligner, "flatstart"),
+             "train.epochs": (Aligner, "train"),
+             "train.small_pause": (Aligner, "small_pause"),
+             "train.realign": (Aligner, "realign"),
+             "align.HVite": (Aligner, "_align"),
+             "align.textgrid": (aligner.api, "write_textgrid")}
+
+
+
+class Timings(object):
+
+    """
+    Accumulated wall-clock time and number of calls, by name
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def add(self, name, seconds):
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def report(self):
+        return {name: {"calls": self.calls[name],
+                       "seconds": round(self.seconds[name], 6)}
+                for name in sorted(self.seconds)}
+
+
+def _timed(function, name, timings):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.add(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument(functions, tools):
+    """
+    Wrap the functions to be timed, and the `Runner` methods which run the
+    HTK tools, so that their timings are added to `functions` and `tools`
+    """
+    for (name, (owner, attribute)) in FUNCTIONS.items():
+        function = owner.__dict__[attribute] if isinstance(owner, type) \
+                   else getattr(owner, attribute)
+        if isinstance(function, staticmethod):
+            setattr(owner, attribute, staticmethod(
+                    _timed(function.__func__, name, functions)))
+        else:
+            setattr(owner, attribute, _timed(function, name, functions))
+
+    def tool(args):
+        return os.path.basename(args[0])
+
+    run = Runner.run
+    stream = Runner.stream
+
+    def timed_run(self, args, *rest, **kwargs):
+        return _timed(run, tool(args), tools)(self, args, *rest, **kwargs)
+
+    @contextmanager
+    def timed_stream(self, args):
+        # timed from the start of the process until it is waited for
+        start = time.perf_counter()
+        try:
+            with stream(self, args) as proc:
+                yield proc
+        finally:
+            tools.add(tool(args), time.perf_counter() - start)
+
+    Runner.run = timed_run
+    Runner.stream = timed_stream
+
+
+@contextmanager
+def stage(name, stages):
+    """
+    Record the wall-clock time, CPU time, and peak (Python) memory of a
+    top-level stage
+    """
+    tracemalloc.reset_peak()
+    (start, cpu) = (time.perf_counter(), time.process_time())
+    yield
+    stages[name] = {"seconds": round(time.perf_counter() - start, 6),
+                    "cpu_seconds": round(time.process_time() - cpu, 6),
+                    "peak_memory": tracemalloc.get_traced_memory()[1]}
+
+
+def fake_path(dirname):
+    """
+    Populate `dirname` with the stand-ins for the HTK tools, and put it at
+    the front of the search path
+    """
+    for name in TOOLS:
+        os.symlink(os.path.join(HERE, "fakehtk.py"),
+                   os.path.join(dirname, name))
+    os.environ["PATH"] = dirname + os.pathsep + os.environ["PATH"]
+
+
+def benchmark(args):
+    tmpdir = mkdtemp(dir=os.environ.get("TMPDIR", None))
+    try:
+        bindir = os.path.join(tmpdir, "bin")
+        os.mkdir(bindir)
+        fake_path(bindir)
+        corpus = os.path.join(tmpdir, "corpus")
+        config = {"size": args.size, "min_duration": args.min_duration,
+                  "max_duration": args.max_duration,
+                  "samplerate": args.samplerate, "subdirs": args.subdirs,
+                  "jobs": args.jobs, "shards": args.shards,
+                  "train": args.train, "epochs": args.epochs}
+        config["duration"] = round(make_corpus(corpus, args.dictionary,
+                                               args.size, args.min_duration,
+                                               args.max_duration,
+                                               args.samplerate,
+                                               args.subdirs), 3)
+        (functions, tools) = (Timings(), Timings())
+        instrument(functions, tools)
+        options = {"jobs": args.jobs, "shards": args.shards}
+        stages = {}
+        tracemalloc.start()
+        start = time.perf_counter()
+        if args.train:
+            with stage("train", stages):
+                model = Model.train(corpus, args.configuration,
+                                    args.dictionary, epochs=args.epochs,
+                                    **options)
+        else:
+            with stage("read", stages):
+                model = Model.read(args.model, args.dictionary, **options)
+            with stage("dictionary", stages):
+                model.thedict
+        with stage("align", stages):
+            model.align(corpus)
+        total = time.perf_counter() - start
+        tracemalloc.stop()
+        return {"config": config,
+                "seconds": round(total, 6),
+                "stages": stages,
+                "functions": functions.report(),
+                "htk": tools.report(),
+                # in kilobytes, on Linux
+                "max_rss": {"self": resource.getrusage(
+                                    resource.RUSAGE_SELF).ru_maxrss,
+                            "children": resource.getrusage(
+                                    resource.RUSAGE_CHILDREN).ru_maxrss}}
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(description="Aligner benchmark")
+    argparser.add_argument("-d", "--dictionary",
+                           default=os.path.join(ROOT, "eng.dict"),
+                           help="dictionary file")
+    argparser.add_argument("-r", "--model",
+                           default=os.path.join(ROOT, "eng.zip"),
+                           help="acoustic model to align with")
+    argparser.add_argument("-c", "--configuration",
+                           default=os.path.join(ROOT, "eng.yaml"),
+                           help="config file, for training")
+    argparser.add_argument("-t", "--train", action="store_true",
+                           help="train a model rather than reading one")
+    argparser.add_argument("-e", "--epochs", type=int, default=1,
+                           help="epochs of training per round")
+    argparser.add_argument("-n", "--size", type=int, default=SIZE,
+                           help="# of utterances (default: {})".format(SIZE))
+    argparser.add_argument("--min-duration", type=float,
+                           default=MIN_DURATION,
+                           help="minimum duration (in seconds)")
+    argparser.add_argument("--max-duration", type=float,
+                           default=MAX_DURATION,
+                           help="maximum duration (in seconds)")
+    argparser.add_argument("-s", "--samplerate", type=int, default=44100,
+                           help="samplerate of the audio (in Hz)")
+    argparser.add_argument("--subdirs", type=int, default=0,
+                           help="# of subdirectories to spread files over")
+    argparser.add_argument("-j", "--jobs", type=int, default=1,
+                           help="# of parallel jobs")
+    argparser.add_argument("--shards", type=int,
+                           help="# of shards to split the corpus into")
+    argparser.add_argument("-o", "--output",
+                           help="file to write results to (default: stdout)")
+    args = argparser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.ERROR)
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, "w") as sink:
+            json.dump(results, sink, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
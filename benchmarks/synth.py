@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# synth.py: generate a synthetic corpus of .wav and .lab files
+#
+# The audio is noise, and the transcripts are random words from a
+# pronunciation dictionary; neither make any sense, but both are of the
+# form (and size) the aligner expects.
+
+import os
+import wave
+
+import numpy as np
+
+from argparse import ArgumentParser
+
+
+SIZE = 100
+MIN_DURATION = 1.
+MAX_DURATION = 5.
+SAMPLERATE = 16000
+# words per second of audio
+WORD_RATE = 3
+SEED = 1
+
+
+def vocabulary(dictionary):
+    """
+    Read the (alphabetic) words in a pronunciation dictionary
+    """
+    words = set()
+    with open(dictionary, "r") as source:
+        for line in source:
+            fields = line.split(None, 1)
+            if fields and fields[0].isalpha():
+                words.add(fields[0])
+    return sorted(words)
+
+
+def make_corpus(dirname, dictionary, size=SIZE, min_duration=MIN_DURATION,
+                max_duration=MAX_DURATION, samplerate=SAMPLERATE,
+                subdirs=0, seed=SEED):
+    """
+    Write `size` pairs of .wav and .lab files into `dirname` (spread over
+    `subdirs` subdirectories, if any), with durations drawn uniformly from
+    [`min_duration`, `max_duration`] seconds, and return their total
+    duration
+    """
+    rng = np.random.RandomState(seed)
+    words = vocabulary(dictionary)
+    total = 0.
+    for i in range(size):
+        head = dirname
+        if subdirs:
+            head = os.path.join(dirname, str(i % subdirs).zfill(3))
+        os.makedirs(head, exist_ok=True)
+        basename = os.path.join(head, "utt{}".format(str(i).zfill(6)))
+        duration = rng.uniform(min_duration, max_duration)
+        total += duration
+        samples = (rng.randn(int(duration * samplerate)) * 1000).astype("<i2")
+        sink = wave.open(basename + ".wav", "wb")
+        sink.setnchannels(1)
+        sink.setsampwidth(2)
+        sink.setframerate(samplerate)
+        sink.writeframes(samples.tobytes())
+        sink.close()
+        with open(basename + ".lab", "w") as sink:
+            print(" ".join(rng.choice(words, max(1, int(duration *
+                                                       WORD_RATE)))),
+                  file=sink)
+    return total
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(description="Synthetic corpus generator")
+    argparser.add_argument("-d", "--dictionary", required=True,
+                           help="dictionary to draw words from")
+    argparser.add_argument("-n", "--size", type=int, default=SIZE,
+                           help="# of utterances (default: {})".format(SIZE))
+    argparser.add_argument("--min-duration", type=float,
+                           default=MIN_DURATION,
+                           help="minimum duration (in seconds)")
+    argparser.add_argument("--max-duration", type=float,
+                           default=MAX_DURATION,
+                           help="maximum duration (in seconds)")
+    argparser.add_argument("-s", "--samplerate", type=int,
+                           default=SAMPLERATE,
+                           help="samplerate (in Hz)")
+    argparser.add_argument("--subdirs", type=int, default=0,
+                           help="# of subdirectories to spread files over")
+    argparser.add_argument("--seed", type=int, default=SEED,
+                           help="random seed")
+    argparser.add_argument("dirname", help="directory to write to")
+    args = argparser.parse_args()
+    total = make_corpus(args.dirname, args.dictionary, args.size,
+                        args.min_duration, args.max_duration,
+                        args.samplerate, args.subdirs, args.seed)
+    print("Wrote {} utterances ({:.1f} seconds).".format(args.size, total))
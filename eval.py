@@ -4,16 +4,30 @@
 
 from __future__ import division
 
+import os
+
+import numpy as np
+
 from textgrid import TextGrid
 
 from sys import argv, stderr
 from collections import namedtuple
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from aligner.mlf import read_mlf, to_textgrid
 
 
 CLOSE_ENOUGH = 20
 TIER_NAME = "phones"
 
+# tolerances (in milliseconds) for whole corpora
+TOLERANCES = (10, 20, 50)
+# files sent to each worker at a time
+CHUNKSIZE = 64
+# initial half-width of the band of the edit distance table
+BAND = 8
+
 
 boundary = namedtuple("boundary", ["transition", "time"])
 
@@ -44,6 +58,188 @@ def is_close_enough(tx, ty, close_enough):
     return abs(tx - ty) < close_enough
 
 
+def _banded_table(x, y, band):
+    """
+    Fill in the edit distance table for the integer sequences `x` and `y`,
+    one row at a time, but only within `band` cells of the diagonal; other
+    cells are left at a value larger than any edit distance
+    """
+    (n, m) = (len(x), len(y))
+    table = np.full((n + 1, m + 1), n + m + 1, dtype=np.int64)
+    table[0, :min(m, band) + 1] = np.arange(min(m, band) + 1)
+    steps = np.arange(m + 1)
+    for i in range(1, n + 1):
+        (lo, hi) = (max(0, i - band), min(m, i + band))
+        prev = table[i - 1]
+        # deletion
+        row = prev[lo:hi + 1] + 1
+        # match or substitution
+        start = max(lo, 1)
+        row[start - lo:] = np.minimum(row[start - lo:],
+                                      prev[start - 1:hi] +
+                                      (y[start - 1:hi] != x[i - 1]))
+        # insertion: the cheapest of row[k] + (j - k) for k <= j
+        offsets = steps[lo:hi + 1]
+        table[i, lo:hi + 1] = np.minimum.accumulate(row - offsets) + \
+                              offsets
+    return table
+
+
+def align_transitions(transitions1, transitions2, band=BAND):
+    """
+    Align two sequences of transitions by edit distance, widening the band
+    of the table computed until it must contain the best alignment, and
+    return arrays of the indices of the matching transitions in each,
+    together with the number of substitutions, deletions (transitions
+    only in the first), and insertions (transitions only in the second)
+    """
+    codes = {}
+    x = np.array([codes.setdefault(t, len(codes)) for t in transitions1],
+                 dtype=np.int64)
+    y = np.array([codes.setdefault(t, len(codes)) for t in transitions2],
+                 dtype=np.int64)
+    (n, m) = (len(x), len(y))
+    band = max(band, abs(n - m))
+    while True:
+        table = _banded_table(x, y, band)
+        # any alignment leaving the band costs more than `band`
+        if table[n, m] <= band or band >= max(n, m):
+            break
+        band *= 2
+    # trace back
+    matched1 = []
+    matched2 = []
+    substitutions = deletions = insertions = 0
+    (i, j) = (n, m)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and \
+                table[i, j] == table[i - 1, j - 1] + (x[i - 1] != y[j - 1]):
+            if x[i - 1] == y[j - 1]:
+                matched1.append(i - 1)
+                matched2.append(j - 1)
+            else:
+                substitutions += 1
+            (i, j) = (i - 1, j - 1)
+        elif i > 0 and table[i, j] == table[i - 1, j] + 1:
+            deletions += 1
+            i -= 1
+        else:
+            insertions += 1
+            j -= 1
+    return (np.array(matched1[::-1], dtype=int),
+            np.array(matched2[::-1], dtype=int),
+            substitutions, deletions, insertions)
+
+
+def textgrids(dirname):
+    """
+    Map the path (relative to `dirname`) of each TextGrid in `dirname`,
+    and the directories below it, to its full path
+    """
+    found = {}
+    for (head, _, filenames) in os.walk(dirname):
+        for filename in filenames:
+            if filename.endswith(".TextGrid"):
+                path = os.path.join(head, filename)
+                found[os.path.relpath(path, dirname)] = path
+    return found
+
+
+def label_files(mlf):
+    """
+    Map the basename of each label file in `mlf` to its (name, lines)
+    """
+    return {os.path.splitext(os.path.basename(name))[0]: (name, lines)
+            for (name, lines) in read_mlf(mlf)}
+
+
+def pairs(one, two):
+    """
+    Pair up the TextGrids in two directories, or the label files in two
+    MLFs, returning a list of (key, source1, source2) triples, and a list
+    of keys found only in one or the other
+    """
+    if os.path.isdir(one) and os.path.isdir(two):
+        (first, secnd) = (textgrids(one), textgrids(two))
+    elif os.path.isfile(one) and os.path.isfile(two):
+        (first, secnd) = (label_files(one), label_files(two))
+    else:
+        exit("Arguments must both be directories or both be MLFs.")
+    paired = [(key, first[key], secnd[key]) for key in
+              sorted(first.keys() & secnd.keys())]
+    unpaired = sorted(first.keys() ^ secnd.keys())
+    return (paired, unpaired)
+
+
+def boundary_array(source, tier_name):
+    """
+    Read the boundaries of the tier named `tier_name` from `source`, a
+    TextGrid filename or an MLF's (name, lines), returning a tuple of
+    transitions and an array of times
+    """
+    if isinstance(source, str):
+        textgrid = TextGrid.fromFile(source)
+    else:
+        textgrid = to_textgrid(*source)
+    found = boundaries(textgrid, tier_name)
+    return (tuple(b.transition for b in found),
+            np.fromiter((b.time for b in found), dtype=float,
+                        count=len(found)))
+
+
+def errors(args):
+    """
+    Compute the absolute errors (in seconds) of the matching boundaries of
+    one pair of files, and the numbers of substitutions, deletions, and
+    insertions needed to align the rest
+    """
+    (key, source1, source2, tier_name) = args
+    (transitions1, times1) = boundary_array(source1, tier_name)
+    (transitions2, times2) = boundary_array(source2, tier_name)
+    (matched1, matched2, *edits) = align_transitions(transitions1,
+                                                     transitions2)
+    return (key, np.abs(times1[matched1] - times2[matched2]), edits)
+
+
+def evaluate(one, two, tier_name, tolerances, jobs=None):
+    """
+    Compare the alignments in `one` and `two` (two directories of
+    TextGrids or two MLFs) file by file, using `jobs` processes, and
+    print the agreement within each of `tolerances` (in milliseconds),
+    and the mean and median absolute error over all matching boundaries
+    """
+    (paired, unpaired) = pairs(one, two)
+    for key in unpaired:
+        print("Unpaired: {}".format(key), file=stderr)
+    if not paired:
+        exit("No files to compare.")
+    found = []
+    edits = np.zeros(3, dtype=int)
+    mismatched = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for (key, result, file_edits) in executor.map(errors,
+                                                      [pair + (tier_name,)
+                                                       for pair in paired],
+                                                      chunksize=CHUNKSIZE):
+            found.append(result)
+            edits += file_edits
+            if any(file_edits):
+                mismatched += 1
+    error = np.concatenate(found) * 1000
+    print("{} files compared ({} unpaired, {} with mismatches).".format(
+          len(found), len(unpaired), mismatched))
+    print("{} matching boundaries.".format(len(error)))
+    print("{} substituted, {} deleted, {} inserted boundaries.".format(
+          *edits))
+    if not len(error):
+        return
+    for tolerance in tolerances:
+        print("Agreement within {} ms: {:.4f}".format(tolerance,
+              np.count_nonzero(error < tolerance) / len(error)))
+    print("Mean absolute error: {:.2f} ms".format(error.mean()))
+    print("Median absolute error: {:.2f} ms".format(np.median(error)))
+
+
 if __name__ == "__main__":
     # check args
     tier_name = TIER_NAME
@@ -53,25 +249,38 @@ if __name__ == "__main__":
                            help="Fudge factor in milliseconds")
     argparser.add_argument("-t", "--tier",
                            help="Name of tier to use")
-    argparser.add_argument("OneGrid")
-    argparser.add_argument("TwoGrid")
+    argparser.add_argument("-j", "--jobs", type=int,
+                           help="# of processes when comparing " +
+                                "directories or MLFs (default: all CPUs)")
+    argparser.add_argument("OneGrid",
+                           help="TextGrid (or directory of them, or MLF)")
+    argparser.add_argument("TwoGrid",
+                           help="TextGrid (or directory of them, or MLF)")
     args = argparser.parse_args()
     if args.fudge:
         close_enough = args.fudge / 1000
     if args.tier:
         tier_name = args.tier
+    # compare whole corpora
+    if os.path.isdir(args.OneGrid) or args.OneGrid.endswith(".mlf"):
+        tolerances = (args.fudge,) if args.fudge else TOLERANCES
+        evaluate(args.OneGrid, args.TwoGrid, tier_name, tolerances,
+                 args.jobs)
+        exit()
     # read in
     first = boundaries(TextGrid.fromFile(args.OneGrid), tier_name)
     secnd = boundaries(TextGrid.fromFile(args.TwoGrid), tier_name)
+    # match up boundaries, tolerating differences in the labels
+    (matched1, matched2, substitutions, deletions, insertions) = \
+        align_transitions([b.transition for b in first],
+                          [b.transition for b in secnd])
+    if not len(matched1):
+        exit("No boundaries match.")
     # count concordant and discordant boundaries
-    if len(first) != len(secnd):
-        exit("Tiers lengths do not match.")
     concordant = 0
     discordant = 0
-    for (boundary1, boundary2) in zip(first, secnd):
-        if boundary1.transition != boundary2.transition:
-            exit("Tier labels do not match.")
-        if is_close_enough(boundary1.time, boundary2.time, close_enough):
+    for (i, j) in zip(matched1, matched2):
+        if is_close_enough(first[i].time, secnd[j].time, close_enough):
             concordant += 1
         else:
             discordant += 1
@@ -79,4 +288,6 @@ if __name__ == "__main__":
     agreement = concordant / (concordant + discordant)
     print("{} 'close enough' boundaries.".format(concordant))
     print("{} incorrect boundaries.".format(discordant))
+    print("{} substituted, {} deleted, {} inserted boundaries.".format(
+          substitutions, deletions, insertions))
     print("Agreement: {:.4f}".format(agreement))
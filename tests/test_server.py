@@ -0,0 +1,78 @@
+# Copyright (c) 2011-2014 Kyle Gorman and Michael Wagner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for the alignment server
+"""
+
+import json
+import unittest
+
+from base64 import b64encode
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from aligner.server import AlignerServer
+
+
+class StubModel(object):
+
+    """
+    Stands in for a `Model`, for requests which are rejected before any
+    alignment is done
+    """
+
+    thedict = None
+
+
+class TestAlignerServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = AlignerServer(("127.0.0.1", 0), StubModel())
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def post(self, request):
+        url = "http://{}:{}/align".format(*self.server.server_address)
+        body = json.dumps(request).encode("UTF-8")
+        try:
+            with urlopen(Request(url, body)) as response:
+                return (response.status, json.load(response))
+        except HTTPError as err:
+            return (err.code, json.load(err))
+
+    def test_hidden_name(self):
+        (code, response) = self.post({"utterances": [
+            {"name": ".hidden", "wav_data": b64encode(b"RIFF").decode(),
+             "text": "HELLO"}]})
+        self.assertEqual(code, 400)
+        self.assertEqual(response["error"],
+                         "Utterance name '.hidden' begins with '.'.")
+
+
+if __name__ == "__main__":
+    unittest.main()